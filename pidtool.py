@@ -3,7 +3,6 @@
 
 import argparse
 import numpy as np
-from numpy.random import choice
 import logging
 import json
 from TrafoProbNN import back_transform
@@ -12,61 +11,734 @@ import ROOT as R
 logging.basicConfig(level=logging.INFO)
 
 
-class Resampler:
-    def __init__(self, *args):
+# Sampling backends understood by Resampler.sample
+BACKENDS = ('cdf', 'alias', 'grouped', 'interp')
+# Backends that only need the kinematic cell of every event, see
+# Resampler.sample_cells
+CELL_BACKENDS = ('cdf', 'alias', 'grouped')
+# Number of cells compiled at once by QuantileResampler.compile
+QUANTILE_BLOCKSIZE = 4096
+
+
+def _bin_fraction(offset, lower, upper):
+    '''
+    Position of offset between the cumulative bin bounds lower and upper.
+    The position within the cumulative bin is uniform as well, so it doubles
+    as the position inside the target bin.
+    '''
+    width = upper - lower
+    frac = np.divide(
+        offset - lower, width, out=np.zeros_like(width), where=width > 0)
+    return np.clip(frac, 0, 1)
+
+
+def _same_edges(edges, other):
+    return len(edges) == len(other) and all(
+        np.array_equal(a, b) for a, b in zip(edges, other))
+
+
+def _rebin_starts(n_bins, factor, padded):
+    '''
+    Returns the first old bin of every new bin when merging factor adjacent
+    bins. Padded axes keep their under/overflow bins separately.
+    '''
+    if factor < 1:
+        raise ValueError('Rebinning factors have to be positive')
+    if padded:
+        return np.concatenate([[0], np.arange(1, n_bins - 1, factor),
+                               [n_bins - 1]])
+    return np.arange(0, n_bins, factor)
+
+
+def _kinematic_cells(edges, features):
+    '''
+    Returns the raveled index of the kinematic cell of every event, binned
+    like the calibration data, see _lookup_bins
+    '''
+    idx = [_lookup_bins(e, vals) for e, vals in zip(edges, features)]
+    return np.ravel_multi_index(idx, [len(e) - 1 for e in edges])
+
+
+def _lookup_bins(edges, values):
+    '''
+    Returns the bin index of every value like _digitize, so that events are
+    sampled from the cells their values were learned into. Values outside
+    of the edges (and NaN) go to the first or last bin, the under/overflow
+    bins of the kinematic axes.
+    '''
+    idx, _ = _digitize(edges, np.asarray(values, dtype=float))
+    return np.clip(idx, 0, len(edges) - 2)
+
+
+def _learning_cells(edges, features):
+    '''
+    Returns the raveled index of the kinematic cell of every calibration
+    event, binned like np.histogramdd, and the mask of events inside the
+    edges
+    '''
+    idx, valid = zip(*[_digitize(e, vals) for e, vals in zip(edges, features)])
+    valid = np.logical_and.reduce(valid)
+    cells = np.ravel_multi_index([np.where(valid, i, 0) for i in idx],
+                                 [len(e) - 1 for e in edges])
+    return cells, valid
+
+
+def _digitize(edges, values):
+    '''
+    Returns the bin index of every value using the conventions of
+    np.histogramdd (the last bin includes its upper edge) together with a
+    mask of the values inside the edges
+    '''
+    n_bins = len(edges) - 1
+    width = (edges[-1] - edges[0]) / n_bins
+    if np.isfinite(width) and width > 0 and np.allclose(
+            np.diff(edges), width):
+        # Equidistant edges: compute the bin directly and correct for
+        # rounding by comparing to its edges, which is much faster than a
+        # binary search
+        with np.errstate(invalid='ignore'):
+            guess = np.floor((values - edges[0]) / width)
+        guess = np.clip(np.nan_to_num(guess), 0, n_bins - 1).astype(int)
+        idx = guess - (values < edges[guess]) + (values >= edges[guess + 1])
+        idx[np.isnan(values)] = n_bins
+    else:
+        idx = np.searchsorted(edges, values, side='right') - 1
+    idx[values == edges[-1]] = n_bins - 1
+    valid = (idx >= 0) & (idx < n_bins)
+    return idx, valid
+
+
+class _Combinable:
+    '''
+    Arithmetic of resamplers with compatible binnings: r1 + r2 adds the
+    calibration data, w * r scales its weights, e.g. to weight magnet
+    polarities or years by their luminosity.
+    '''
+
+    def __add__(self, other):
+        rv = self.copy()
+        rv += other
+        return rv
+
+    def __iadd__(self, other):
+        self._check_compatible(other)
+        self._add(other)
+        return self
+
+    def __mul__(self, factor):
+        rv = self.copy()
+        rv._scale(factor)
+        return rv
+
+    __rmul__ = __mul__
+
+
+def _nearest_populated(populated):
+    '''
+    Returns for every raveled cell of the boolean grid populated the raveled
+    index of the nearest populated cell, counted in steps along the axes.
+    The populated region is grown one step per iteration, ties go to the
+    neighbour along the first axis. At least one cell has to be populated.
+    '''
+    nearest = np.where(populated.ravel(), np.arange(populated.size), -1)
+    nearest = nearest.reshape(populated.shape)
+    while (nearest < 0).any():
+        grown = nearest.copy()
+        for axis in range(nearest.ndim):
+            for source, target in ((slice(1, None), slice(None, -1)),
+                                   (slice(None, -1), slice(1, None))):
+                index = [slice(None)] * nearest.ndim
+                index[axis] = source
+                neighbour = nearest[tuple(index)]
+                index[axis] = target
+                cells = grown[tuple(index)]
+                fill = (cells < 0) & (neighbour >= 0)
+                cells[fill] = neighbour[fill]
+        nearest = grown
+    return nearest.ravel()
+
+
+class _CellFallback:
+    '''
+    Optional table of fallback cells: redirect[cell] is the kinematic cell
+    whose calibration data is used for events in cell, see build_redirect.
+    '''
+
+    def build_redirect(self, threshold=0):
+        '''
+        Redirects every kinematic cell without calibration data, or with a
+        sum of weights below threshold, to the nearest cell with enough
+        data. Afterwards sampling looks up the fallback cell directly and
+        only fails if no cell has enough data.
+        '''
+        weights = self._cell_weights()
+        populated = (weights > 0) & (weights >= threshold)
+        self.redirect = None
+        if populated.any():
+            self.redirect = _nearest_populated(populated)
+        else:
+            logging.warning(
+                'No kinematic cell has a sum of weights of at least {}, no '
+                'fallback cells are used'.format(threshold))
+
+    def _redirect_cells(self, cells):
+        if self.redirect is None:
+            return cells
+        return self.redirect[cells]
+
+    def redirected_cells(self, cells):
+        '''
+        Returns the mask of events in the given kinematic cells that are
+        sampled from a fallback cell
+        '''
+        return self._redirect_cells(cells) != cells
+
+
+class _CalibrationStats:
+    '''
+    Sum of weights and of squared weights of the calibration data in every
+    kinematic cell. stats holds both as columns, one row per stored cell, or
+    is None for resamplers created by older versions.
+    '''
+
+    def calibration_stats(self, cells):
+        '''
+        Returns the sum of weights and the effective number of entries
+        (sum of weights squared over sum of squared weights) of the
+        calibration data that events in the given cells are sampled from
+        '''
+        if self.stats is None:
+            nan = np.full(len(cells), np.nan)
+            return nan, nan.copy()
+        sumw, sumw2 = self._cell_stats(self._redirect_cells(cells)).T
+        neff = np.divide(
+            sumw**2, sumw2, out=np.zeros(len(cells)), where=sumw2 > 0)
+        return sumw, neff
+
+    def _cell_stats(self, cells):
+        rows = self._row_index(cells)
+        return np.where(rows[:, np.newaxis] >= 0,
+                        self.stats[np.maximum(rows, 0)], 0)
+
+
+class _KinematicTable:
+    '''
+    Pickling, cell lookup and per-kind diagnostics shared by
+    ReservoirResampler and QuantileResampler, which sample all requested
+    kinds from one kinematic cell lookup. _kinematic_edges are the edges of
+    the kinematic axes. Resamplers mapped from a binary file are pickled as
+    a reference to it.
+    '''
+
+    def __getstate__(self):
+        if self._source is not None:
+            return {'_source': self._source}
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        if 'edges' not in state:
+            path, kind = state['_source']
+            state = load_resamplers(path, [kind])[kind].__dict__
+        self.__dict__.update(state)
+        self.__dict__.setdefault('redirect', None)
+        self.__dict__.setdefault('stats', None)
+        self._cache = {}
+
+    def _kinematic_edges(self):
+        return self.edges
+
+    def cells(self, features):
+        '''
+        Returns the raveled index of the kinematic cell of every event
+        '''
+        return _kinematic_cells(self._kinematic_edges(), features)
+
+    def redirected_many(self, features, kinds):
+        '''
+        Returns the mask of events sampled from a fallback cell, of shape
+        (len(kinds), n_events)
+        '''
+        redirected = self.redirected_cells(self.cells(np.asarray(features)))
+        return np.tile(redirected, (len(kinds), 1))
+
+    def calibration_stats_many(self, features, kinds):
+        '''
+        Returns the sum of weights and the effective number of entries of
+        the calibration data used for every event, see calibration_stats,
+        both of shape (len(kinds), n_events)
+        '''
+        sumw, neff = self.calibration_stats(self.cells(np.asarray(features)))
+        return np.tile(sumw, (len(kinds), 1)), np.tile(neff, (len(kinds), 1))
+
+
+def _weight_stats(cells, weights, minlength=0):
+    '''
+    Returns the sum of weights and of squared weights per cell
+    '''
+    if weights is None:
+        weights = np.ones(len(cells))
+    return np.stack([
+        np.bincount(cells, weights, minlength=minlength),
+        np.bincount(cells, weights**2, minlength=minlength)
+    ], axis=1)
+
+
+class Resampler(_Combinable, _CellFallback, _CalibrationStats):
+    def __init__(self, *args, backend='cdf', dtype=np.float64):
         # Choose histogram size according to bin edges
         # Take under/overflow into account for dependent variables only
         edges = []
         self.histogram = None
+        self.backend = backend
+        self.dtype = np.dtype(dtype)
+        # Sampling tables derived from the histogram, rebuilt after learning
+        self._cache = {}
+        # Fallback cells for empty cells, see build_redirect
+        self.redirect = None
+        self.stats = None
+        # (path, kind) of the resampler file this resampler is mapped from
+        self._source = None
         if args:
-            print('Creating resampler with args')
             for arg in args[:-1]:
                 edges.append(np.append(np.append([-np.inf], arg), [np.inf]))
             edges.append(args[-1])
             self.edges = edges
-
-            self.histogram = np.zeros([len(x) - 1 for x in self.edges])
+            self._allocate()
+
+    def _allocate(self):
+        self.histogram = np.zeros([len(x) - 1 for x in self.edges],
+                                  dtype=self.dtype)
+        self.stats = np.zeros((self.histogram[..., 0].size, 2))
+
+    def __getstate__(self):
+        if self._source is not None:
+            # Mapped resamplers travel as a reference to their file, so that
+            # all processes share the same pages
+            return {'_source': self._source, 'backend': self.backend}
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        if 'edges' not in state:
+            path, kind = state['_source']
+            mapped = load_resamplers(path, [kind])[kind]
+            state = dict(mapped.__dict__, backend=state['backend'])
+        # Resamplers pickled by older versions carry neither cache nor backend
+        self.__dict__.update(state)
+        self.__dict__.setdefault('backend', 'cdf')
+        self.__dict__.setdefault('_source', None)
+        self.__dict__.setdefault('redirect', None)
+        self.__dict__.setdefault('stats', None)
+        if 'dtype' not in self.__dict__:
+            self.dtype = self.histogram.dtype
+        self._cache = {}
+
+    def _to_arrays(self):
+        '''
+        Returns the attributes and arrays stored in resampler files
+        '''
+        arrays = {'edges_{}'.format(i): e for i, e in enumerate(self.edges)}
+        arrays['histogram'] = self.histogram
+        if self.redirect is not None:
+            arrays['redirect'] = self.redirect
+        if self.stats is not None:
+            arrays['stats'] = self.stats
+        return {'backend': self.backend, 'n_edges': len(self.edges)}, arrays
+
+    @classmethod
+    def _from_arrays(cls, attrs, arrays):
+        rv = cls(backend=attrs['backend'])
+        rv.edges = [
+            arrays['edges_{}'.format(i)] for i in range(attrs['n_edges'])
+        ]
+        rv.histogram = arrays['histogram']
+        rv.dtype = rv.histogram.dtype
+        rv.redirect = arrays.get('redirect')
+        rv.stats = arrays.get('stats')
+        return rv
 
     def copy(self):
         '''
         Creates a copy of the resampler
         '''
-        rv = Resampler()
+        rv = Resampler(backend=self.backend, dtype=self.dtype)
         rv.edges = list(self.edges)
         rv.histogram = self.histogram.copy()
+        if self.redirect is not None:
+            rv.redirect = self.redirect.copy()
+        if self.stats is not None:
+            rv.stats = self.stats.copy()
         return rv
 
     def learn(self, features, weights=None):
         assert (len(features) == len(self.edges))
 
-        features = np.array(features)
+        features = np.asarray(features)
+        cells, valid = self.learning_cells(features[:-1])
+        self.learn_cells(cells, features[-1], weights, valid)
 
-        h, _ = np.histogramdd(features.T, bins=self.edges, weights=weights)
-        self.histogram += h
+    def learning_cells(self, features):
+        '''
+        Returns the raveled index of the kinematic cell of every calibration
+        event, binned like np.histogramdd, and the mask of valid events.
+        '''
+        return _learning_cells(self.edges[:-1], features)
 
-    def sample(self, features):
+    def learn_cells(self, cells, values, weights=None, valid=None):
+        '''
+        Fills the histogram with target values of events in known kinematic
+        cells (see learning_cells), so that the kinematics of a chunk only
+        need to be binned once for all PID variables.
+        '''
+        target, target_valid = _digitize(self.edges[-1], np.asarray(values))
+        if valid is not None:
+            target_valid &= valid
+        if weights is not None:
+            weights = np.asarray(weights)[target_valid]
+        counts = np.bincount(
+            cells[target_valid] * self.shape[-1] + target[target_valid],
+            weights=weights)
+        self._store(counts, _weight_stats(cells[target_valid], weights))
+        self._cache.clear()
+        self.redirect = None
+
+    def _store(self, counts, stats):
+        '''
+        Adds counts, indexed by cell * n_target + target bin, to the histogram
+        and the calibration statistics, indexed by cell, to stats
+        '''
+        self.histogram.reshape(-1)[:len(counts)] += counts
+        if self.stats is not None:
+            self.stats[:len(stats)] += stats
 
-        assert (len(features) == len(self.edges) - 1)
-        args = np.array(features)
-        idx = [
-            np.searchsorted(edges, vals) - 1
-            for edges, vals in zip(self.edges, args)
+    def _add(self, other):
+        '''
+        Adds the histogram of a resampler with the same binning
+        '''
+        if other.histogram is None:
+            self._rows()[other._row_cells()] += other._rows()
+        else:
+            self.histogram += other.histogram
+        if self.stats is not None and other.stats is not None:
+            self.stats[other._row_cells()] += other.stats
+        else:
+            self.stats = None
+        self._cache.clear()
+        self.redirect = None
+
+    def _cell_weights(self):
+        weights = np.zeros(int(np.prod(self.shape[:-1])))
+        weights[self._row_cells()] = np.clip(self._rows(), 0, None).sum(
+            axis=1)
+        return weights.reshape(self.shape[:-1])
+
+    def _scale(self, factor):
+        self._rows()[...] *= factor
+        if self.stats is not None:
+            self.stats = self.stats * [factor, factor**2]
+        self._cache.clear()
+        self.redirect = None
+
+    def _check_compatible(self, other):
+        if not isinstance(other, Resampler):
+            raise TypeError('Cannot combine {} with a {}'.format(
+                type(self).__name__, type(other).__name__))
+        if not _same_edges(self.edges, other.edges):
+            raise ValueError('Resamplers have different bin edges')
+
+    def _rebin_starts(self, factors):
+        if len(factors) != len(self.edges):
+            raise ValueError('Expected {} rebinning factors, got {}'.format(
+                len(self.edges), len(factors)))
+        return [
+            _rebin_starts(len(e) - 1, factor, i < len(self.edges) - 1)
+            for i, (e, factor) in enumerate(zip(self.edges, factors))
+        ]
+
+    def rebin(self, factors):
+        '''
+        Returns a coarser resampler in which factors[i] adjacent bins along
+        axis i (the kinematic axes followed by the target axis) are merged.
+        The under/overflow bins of the kinematic axes are kept.
+        '''
+        starts = self._rebin_starts(factors)
+        rv = Resampler(backend=self.backend, dtype=self.dtype)
+        rv.edges = [
+            e[np.append(s, len(e) - 1)] for e, s in zip(self.edges, starts)
         ]
-        tmp = self.histogram[idx]
+        rv.histogram = self.histogram
+        for axis, s in enumerate(starts):
+            rv.histogram = np.add.reduceat(rv.histogram, s, axis=axis)
+        if self.stats is not None:
+            rv.stats = self.stats.reshape(self.shape[:-1] + (2, ))
+            for axis, s in enumerate(starts[:-1]):
+                rv.stats = np.add.reduceat(rv.stats, s, axis=axis)
+            rv.stats = rv.stats.reshape(-1, 2)
+        return rv
+
+    @property
+    def shape(self):
+        '''
+        Number of bins along every axis, including under/overflow bins
+        '''
+        return tuple(len(x) - 1 for x in self.edges)
+
+    def cells(self, features):
+        '''
+        Returns the raveled index of the kinematic cell of every event
+        '''
+        return _kinematic_cells(self.edges[:-1], features)
+
+    def _rows(self):
+        '''
+        Returns the target histograms of the stored kinematic cells, one row
+        per cell
+        '''
+        return self.histogram.reshape(-1, self.histogram.shape[-1])
+
+    def _row_cells(self):
+        '''
+        Returns the raveled kinematic cell index of every row of _rows
+        '''
+        return np.arange(len(self._rows()))
+
+    def _row_index(self, cells):
+        '''
+        Returns the row of _rows for every kinematic cell, -1 if the cell is
+        not stored
+        '''
+        return cells
+
+    def _probabilities(self):
+        '''
+        Returns the target histogram with one row per stored cell,
+        normalised to unit sum, together with a mask of the rows that can
+        be sampled from.
+        '''
         # Fix negative bins (resulting from possible negative weights) to zero
-        tmp[tmp < 0] = 0
-        norm = np.sum(tmp, axis=1)
-        probs = tmp / norm[:, np.newaxis]
-        sampled_bin = []
-        for i in range(tmp.shape[0]):
-            sampled_bin.append(choice(tmp.shape[1], p=probs[i, :]))
-        sampled_bin = np.array(sampled_bin)
-        sampled_val = np.random.uniform(
-            self.edges[-1][sampled_bin],
-            self.edges[-1][sampled_bin + 1],
-            size=len(sampled_bin))
+        probs = np.clip(self._rows(), 0, None).astype(np.float64, copy=False)
+        norm = probs.sum(axis=1)
+        filled = norm > 0
+        probs[filled] /= norm[filled, np.newaxis]
+        return probs, filled
+
+    def _cdf_table(self):
+        '''
+        Returns the normalised cumulative distribution of the target variable
+        for every stored cell together with the mask of filled rows.
+        Row i is offset by i, so the flattened table is sorted and a single
+        searchsorted call inverts the distributions of all events at once.
+        '''
+        if 'cdf' not in self._cache:
+            probs, filled = self._probabilities()
+            cdf = np.cumsum(probs, axis=1)
+            cdf[filled, -1] = 1
+            cdf += np.arange(len(cdf))[:, np.newaxis]
+            self._cache['cdf'] = cdf, filled
+        return self._cache['cdf']
+
+    def _alias_table(self):
+        '''
+        Returns Walker alias tables (acceptance probability and alias bin)
+        for every stored cell together with the mask of filled rows.
+        The tables are built with Vose's method, processing all rows in
+        lockstep: every pass pairs one column below the mean of each row with
+        one above it, so every column is paired at most once.
+        '''
+        if 'alias' not in self._cache:
+            probs, filled = self._probabilities()
+            n_rows, n_target = probs.shape
+            scaled = probs * n_target
+            scaled[~filled] = 1
+            accept = np.ones_like(scaled)
+            alias = np.tile(np.arange(n_target), (n_rows, 1))
+            # worklists of the columns below and above the mean, stored as
+            # stacks in the first n_small / n_large entries of each row
+            is_large = scaled >= 1
+            small = np.argsort(is_large, axis=1, kind='stable')
+            large = small[:, ::-1].copy()
+            n_large = is_large.sum(axis=1)
+            n_small = n_target - n_large
+            rows = np.arange(n_rows)
+            while True:
+                r = rows[(n_small > 0) & (n_large > 0)]
+                if not len(r):
+                    break
+                n_small[r] -= 1
+                s, l = small[r, n_small[r]], large[r, n_large[r] - 1]
+                accept[r, s] = scaled[r, s]
+                alias[r, s] = l
+                scaled[r, l] -= 1 - scaled[r, s]
+                # columns that dropped below the mean move to the small list
+                moved = scaled[r, l] < 1
+                r, l = r[moved], l[moved]
+                n_large[r] -= 1
+                small[r, n_small[r]] = l
+                n_small[r] += 1
+            self._cache['alias'] = accept, alias, filled
+        return self._cache['alias']
+
+    def _sample_cdf(self, rows, uniforms):
+        cdf, filled = self._cdf_table()
+        n_target = cdf.shape[1]
+        offset = rows + uniforms[0]
+        pos = np.searchsorted(cdf.ravel(), offset, side='right')
+        sampled_bin = np.clip(pos - rows * n_target, 0, n_target - 1)
+        pos = rows * n_target + sampled_bin
+        upper = cdf.ravel()[pos]
+        lower = np.where(sampled_bin > 0, cdf.ravel()[pos - 1], rows)
+        return sampled_bin, _bin_fraction(offset, lower, upper), filled[rows]
+
+    def _sample_grouped(self, rows, uniforms):
+        '''
+        Same as the cdf backend, but sorts the events by kinematic cell and
+        inverts the distribution of each occupied cell once for all of its
+        events. Only the rows of occupied cells are touched.
+        '''
+        cdf, filled = self._cdf_table()
+        n_target = cdf.shape[1]
+        order = np.argsort(rows, kind='stable')
+        occupied, starts = np.unique(rows[order], return_index=True)
+        sampled_bin = np.empty(len(rows), dtype=int)
+        frac = np.empty(len(rows))
+        for row_index, events in zip(occupied, np.split(order, starts[1:])):
+            row = cdf[row_index]
+            offset = row_index + uniforms[0][events]
+            row_bin = np.minimum(
+                np.searchsorted(row, offset, side='right'), n_target - 1)
+            lower = np.where(row_bin > 0, row[row_bin - 1], row_index)
+            sampled_bin[events] = row_bin
+            frac[events] = _bin_fraction(offset, lower, row[row_bin])
+        return sampled_bin, frac, filled[rows]
+
+    def _sample_alias(self, rows, uniforms):
+        accept, alias, filled = self._alias_table()
+        n_target = accept.shape[1]
+        column = uniforms[0] * n_target
+        sampled_bin = np.minimum(column.astype(int), n_target - 1)
+        # The fractional part is independent of the chosen column and places
+        # the value inside the target bin
+        frac = column - sampled_bin
+        rejected = uniforms[1] >= accept[rows, sampled_bin]
+        sampled_bin[rejected] = alias[rows[rejected], sampled_bin[rejected]]
+        return sampled_bin, frac, filled[rows]
+
+    def sample_cells(self, cells, uniforms=None, backend=None):
+        '''
+        Samples the target variable for events in the given kinematic cells.
+        uniforms are optional random numbers in [0, 1) of shape (2, n_events).
+        backend overrides the sampling backend of the resampler.
+        '''
+        backend = backend or self.backend
+        if backend not in CELL_BACKENDS:
+            raise ValueError(
+                'Unknown sampling backend {} for kinematic cells'.format(
+                    backend))
+        if uniforms is None:
+            uniforms = np.random.uniform(size=(2, len(cells)))
+        rows = self._row_index(self._redirect_cells(cells))
+        stored = rows >= 0
+        if not stored.any():
+            return np.full(len(cells), -1000.)
+        sampled_bin, frac, filled = getattr(self, '_sample_' + backend)(
+            np.where(stored, rows, 0), uniforms)
+        target_edges = self.edges[-1]
+        sampled_val = target_edges[sampled_bin] + frac * (
+            target_edges[sampled_bin + 1] - target_edges[sampled_bin])
         # If the histogram is empty, we can't sample
-        sampled_val[norm == 0] = -1000
+        sampled_val[~(filled & stored)] = -1000
+        return sampled_val
+
+    def _interp_corners(self, features):
+        '''
+        Returns the rows of the 2^d cells whose centres surround every event
+        (-1 if not stored) and their multilinear weights. Along the under/
+        overflow bins and beyond the outermost centres nothing is
+        interpolated.
+        '''
+        lower, upper_weight = [], []
+        for e, x in zip(self.edges[:-1], features):
+            n_bins = len(e) - 1
+            idx = _lookup_bins(e, x)
+            inner = (idx >= 1) & (idx <= n_bins - 2)
+            i = np.clip(idx, 1, n_bins - 2)
+            position = i + (x - e[i]) / (e[i + 1] - e[i]) - 0.5
+            position = np.where(inner, np.clip(position, 1, n_bins - 2), idx)
+            lower.append(np.floor(position).astype(int))
+            upper_weight.append(position - lower[-1])
+        corners = []
+        for corner in np.ndindex(*[2] * len(lower)):
+            index = [
+                np.minimum(lo + c, len(e) - 2)
+                for lo, c, e in zip(lower, corner, self.edges)
+            ]
+            weight = np.prod([
+                w if c else 1 - w for w, c in zip(upper_weight, corner)
+            ], axis=0)
+            cells = np.ravel_multi_index(index, self.shape[:-1])
+            corners.append((self._row_index(self._redirect_cells(cells)),
+                            weight))
+        return corners
+
+    def _sample_interp(self, features, uniforms):
+        '''
+        Samples by inverting, for every event, the weighted average of the
+        cumulative target distributions of the cells around it (see
+        _interp_corners). Empty cells do not contribute. The averaged
+        distribution is only evaluated at the bins probed by a bisection.
+        '''
+        cdf, filled = self._cdf_table()
+        n_target = cdf.shape[1]
+        flat = cdf.ravel()
+        rows, weights = [], []
+        for corner_rows, weight in self._interp_corners(features):
+            weights.append(
+                np.where(corner_rows >= 0, weight, 0) *
+                filled[np.maximum(corner_rows, 0)])
+            rows.append(np.maximum(corner_rows, 0))
+        norm = np.sum(weights, axis=0)
+        ok = norm > 0
+        rows = [r[ok] for r in rows]
+        weights = [w[ok] / norm[ok] for w in weights]
+
+        def blended(bins):
+            # rows of the table are offset by their index, see _cdf_table
+            return sum(w * (flat[r * n_target + bins] - r)
+                       for r, w in zip(rows, weights))
+
+        u = uniforms[0][ok]
+        lower = np.zeros(len(u), dtype=int)
+        upper = np.full(len(u), n_target - 1)
+        while (lower < upper).any():
+            middle = (lower + upper) // 2
+            above = blended(middle) > u
+            upper = np.where(above, middle, upper)
+            lower = np.where(above, lower, middle + 1)
+        sampled_bin = np.minimum(lower, n_target - 1)
+        frac = _bin_fraction(
+            u,
+            np.where(sampled_bin > 0, blended(np.maximum(sampled_bin - 1, 0)),
+                     0), blended(sampled_bin))
+        target_edges = self.edges[-1]
+        sampled_val = np.full(len(ok), -1000.)
+        sampled_val[ok] = target_edges[sampled_bin] + frac * (
+            target_edges[sampled_bin + 1] - target_edges[sampled_bin])
+        return sampled_val
+
+    def sample(self, features, uniforms=None, backend=None):
+
+        assert (len(features) == len(self.edges) - 1)
+        features = np.asarray(features)
+        if (backend or self.backend) == 'interp':
+            if uniforms is None:
+                uniforms = np.random.uniform(size=(2, len(features[0])))
+            sampled_val = self._sample_interp(features, uniforms)
+        else:
+            sampled_val = self.sample_cells(
+                self.cells(features), uniforms, backend)
 
         assert(len(features[0]) == len(sampled_val)), \
             ('Resampled values are too few.\n'
@@ -75,6 +747,1149 @@ class Resampler:
         return sampled_val
 
 
+class SparseResampler(Resampler):
+    '''
+    Resampler that only stores the target histograms of occupied kinematic
+    cells: occupied holds the sorted raveled cell indices and counts the
+    corresponding rows of the histogram. Allows for fine kinematic binning.
+    '''
+
+    def _allocate(self):
+        self.occupied = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros((0, len(self.edges[-1]) - 1), dtype=self.dtype)
+        self.stats = np.zeros((0, 2))
+
+    def _to_arrays(self):
+        arrays = {'edges_{}'.format(i): e for i, e in enumerate(self.edges)}
+        arrays['occupied'] = self.occupied
+        arrays['counts'] = self.counts
+        if self.redirect is not None:
+            arrays['redirect'] = self.redirect
+        if self.stats is not None:
+            arrays['stats'] = self.stats
+        return {'backend': self.backend, 'n_edges': len(self.edges)}, arrays
+
+    @classmethod
+    def _from_arrays(cls, attrs, arrays):
+        rv = cls(backend=attrs['backend'])
+        rv.edges = [
+            arrays['edges_{}'.format(i)] for i in range(attrs['n_edges'])
+        ]
+        rv.occupied = arrays['occupied']
+        rv.counts = arrays['counts']
+        rv.dtype = rv.counts.dtype
+        rv.redirect = arrays.get('redirect')
+        rv.stats = arrays.get('stats')
+        return rv
+
+    def copy(self):
+        '''
+        Creates a copy of the resampler
+        '''
+        rv = SparseResampler(backend=self.backend, dtype=self.dtype)
+        rv.edges = list(self.edges)
+        rv.occupied = self.occupied.copy()
+        rv.counts = self.counts.copy()
+        if self.redirect is not None:
+            rv.redirect = self.redirect.copy()
+        if self.stats is not None:
+            rv.stats = self.stats.copy()
+        return rv
+
+    def learn_cells(self, cells, values, weights=None, valid=None):
+        '''
+        Fills the histogram like Resampler.learn_cells, counting the events
+        in rows of the occupied cells only
+        '''
+        target, target_valid = _digitize(self.edges[-1], np.asarray(values))
+        if valid is not None:
+            target_valid &= valid
+        if weights is not None:
+            weights = np.asarray(weights)[target_valid]
+        cells, rows = np.unique(cells[target_valid], return_inverse=True)
+        n_target = self.counts.shape[1]
+        counts = np.bincount(
+            rows * n_target + target[target_valid],
+            weights=weights,
+            minlength=len(cells) * n_target).reshape(len(cells), n_target)
+        self._store(cells, counts, _weight_stats(rows, weights, len(cells)))
+        self._cache.clear()
+        self.redirect = None
+
+    def _store(self, cells, counts, stats):
+        '''
+        Adds the target histograms counts and the calibration statistics
+        stats of the given sorted cells
+        '''
+        filled = counts.any(axis=1) | stats.any(axis=1)
+        cells, counts, stats = cells[filled], counts[filled], stats[filled]
+        occupied = np.union1d(self.occupied, cells)
+        if len(occupied) > len(self.occupied):
+            rows = np.searchsorted(occupied, self.occupied)
+            new_counts = np.zeros((len(occupied), counts.shape[1]),
+                                  dtype=self.dtype)
+            new_counts[rows] = self.counts
+            if self.stats is not None:
+                new_stats = np.zeros((len(occupied), 2))
+                new_stats[rows] = self.stats
+                self.stats = new_stats
+            self.occupied, self.counts = occupied, new_counts
+        rows = np.searchsorted(self.occupied, cells)
+        self.counts[rows] += counts
+        if self.stats is not None:
+            self.stats[rows] += stats
+
+    def _add(self, other):
+        other_cells, other_counts = other._row_cells(), other._rows()
+        other_stats = other.stats
+        if other.histogram is not None:
+            filled = other_counts.any(axis=1)
+            if other_stats is not None:
+                filled |= other_stats.any(axis=1)
+                other_stats = other_stats[filled]
+            other_cells, other_counts = other_cells[filled], other_counts[
+                filled]
+        occupied = np.union1d(self.occupied, other_cells)
+        counts = np.zeros((len(occupied), self.counts.shape[1]),
+                          dtype=self.dtype)
+        counts[np.searchsorted(occupied, self.occupied)] += self.counts
+        counts[np.searchsorted(occupied, other_cells)] += other_counts
+        if self.stats is not None and other_stats is not None:
+            stats = np.zeros((len(occupied), 2))
+            stats[np.searchsorted(occupied, self.occupied)] += self.stats
+            stats[np.searchsorted(occupied, other_cells)] += other_stats
+            self.stats = stats
+        else:
+            self.stats = None
+        self.occupied, self.counts = occupied, counts
+        self._cache.clear()
+        self.redirect = None
+
+    def _rows(self):
+        return self.counts
+
+    def _row_cells(self):
+        return self.occupied
+
+    def _row_index(self, cells):
+        rows = np.searchsorted(self.occupied, cells)
+        found = rows < len(self.occupied)
+        found[found] = self.occupied[rows[found]] == cells[found]
+        return np.where(found, rows, -1)
+
+    def rebin(self, factors):
+        starts = self._rebin_starts(factors)
+        rv = SparseResampler(backend=self.backend, dtype=self.dtype)
+        rv.edges = [
+            e[np.append(s, len(e) - 1)] for e, s in zip(self.edges, starts)
+        ]
+        rv._allocate()
+        if not len(self.occupied):
+            return rv
+        index = np.unravel_index(self.occupied, self.shape[:-1])
+        cells = np.ravel_multi_index([
+            np.searchsorted(s, i, side='right') - 1
+            for s, i in zip(starts, index)
+        ], rv.shape[:-1])
+        counts = np.add.reduceat(self.counts, starts[-1], axis=1)
+        order = np.argsort(cells, kind='stable')
+        rv.occupied, first = np.unique(cells[order], return_index=True)
+        rv.counts = np.add.reduceat(counts[order], first, axis=0)
+        rv.stats = None
+        if self.stats is not None:
+            rv.stats = np.add.reduceat(self.stats[order], first, axis=0)
+        return rv
+
+    def to_dense(self):
+        '''
+        Returns the equivalent Resampler with a dense histogram
+        '''
+        rv = Resampler(backend=self.backend, dtype=self.dtype)
+        rv.edges = list(self.edges)
+        rv._allocate()
+        rv._rows()[self.occupied] = self.counts
+        rv.redirect = self.redirect
+        if self.stats is None:
+            rv.stats = None
+        else:
+            rv.stats[self.occupied] = self.stats
+        return rv
+
+
+class ReservoirResampler(_Combinable, _CellFallback, _CalibrationStats,
+                         _KinematicTable):
+    '''
+    Joint resampler for several PID variables of one particle. Instead of
+    histograms it keeps a random subset of at most capacity calibration
+    rows (all PID variables and the sWeight) per kinematic cell and draws
+    complete rows, which preserves the correlations between the PID
+    variables. Negative sWeights are set to zero when drawing.
+    '''
+
+    def __init__(self, *args, kinds=(), capacity=1000):
+        self.kinds = list(kinds)
+        self.capacity = capacity
+        self._cache = {}
+        self._source = None
+        self.redirect = None
+        self.stats = None
+        if args:
+            self.edges = [
+                np.append(np.append([-np.inf], arg), [np.inf]) for arg in args
+            ]
+            # statistics of all learned rows, not only of the kept ones
+            self.stats = np.zeros((int(np.prod([len(e) - 1
+                                                for e in self.edges])), 2))
+            # Rows are sorted by cell and, within a cell, by their key. Only
+            # the rows with the smallest keys are kept, which gives a uniform
+            # random subset that does not depend on the order of learning.
+            self.row_cells = np.zeros(0, dtype=np.int64)
+            self.keys = np.zeros(0)
+            self.values = np.zeros((0, len(self.kinds)), dtype=np.float32)
+            self.weights = np.zeros(0, dtype=np.float32)
+
+    def _to_arrays(self):
+        arrays = {'edges_{}'.format(i): e for i, e in enumerate(self.edges)}
+        arrays.update(
+            row_cells=self.row_cells,
+            keys=self.keys,
+            values=self.values,
+            weights=self.weights)
+        if self.redirect is not None:
+            arrays['redirect'] = self.redirect
+        if self.stats is not None:
+            arrays['stats'] = self.stats
+        return {
+            'kinds': self.kinds,
+            'capacity': self.capacity,
+            'n_edges': len(self.edges)
+        }, arrays
+
+    @classmethod
+    def _from_arrays(cls, attrs, arrays):
+        rv = cls(kinds=attrs['kinds'], capacity=attrs['capacity'])
+        rv.edges = [
+            arrays['edges_{}'.format(i)] for i in range(attrs['n_edges'])
+        ]
+        for name in ('row_cells', 'keys', 'values', 'weights'):
+            setattr(rv, name, arrays[name])
+        rv.redirect = arrays.get('redirect')
+        rv.stats = arrays.get('stats')
+        return rv
+
+    def copy(self):
+        '''
+        Creates a copy of the resampler
+        '''
+        rv = ReservoirResampler(kinds=self.kinds, capacity=self.capacity)
+        rv.edges = list(self.edges)
+        for name in ('row_cells', 'keys', 'values', 'weights'):
+            setattr(rv, name, getattr(self, name).copy())
+        if self.redirect is not None:
+            rv.redirect = self.redirect.copy()
+        if self.stats is not None:
+            rv.stats = self.stats.copy()
+        return rv
+
+    def rebin(self, factors):
+        '''
+        Returns a joint resampler in which factors[i] adjacent bins along
+        kinematic axis i are merged, keeping the under/overflow bins. The
+        merged cells keep the rows with the smallest keys, as if they had
+        been learned with the coarser binning.
+        '''
+        if len(factors) != len(self.edges):
+            raise ValueError('Expected {} rebinning factors, got {}'.format(
+                len(self.edges), len(factors)))
+        starts = [
+            _rebin_starts(len(e) - 1, factor, True)
+            for e, factor in zip(self.edges, factors)
+        ]
+        rv = ReservoirResampler(
+            *[e[np.append(s, len(e) - 1)][1:-1]
+              for e, s in zip(self.edges, starts)],
+            kinds=self.kinds,
+            capacity=self.capacity)
+        index = np.unravel_index(self.row_cells,
+                                 tuple(len(e) - 1 for e in self.edges))
+        cells = np.ravel_multi_index([
+            np.searchsorted(s, i, side='right') - 1
+            for s, i in zip(starts, index)
+        ], tuple(len(e) - 1 for e in rv.edges))
+        rv._keep_rows(cells, self.values.T, self.weights, self.keys)
+        rv.stats = None
+        if self.stats is not None:
+            rv.stats = self.stats.reshape(
+                tuple(len(e) - 1 for e in self.edges) + (2, ))
+            for axis, s in enumerate(starts):
+                rv.stats = np.add.reduceat(rv.stats, s, axis=axis)
+            rv.stats = rv.stats.reshape(-1, 2)
+        return rv
+
+    def learn(self, features, values, weights, keys=None):
+        '''
+        Adds calibration rows to the reservoirs. values holds one row per
+        kind, keys are optional random numbers in [0, 1) that decide which
+        rows are kept once a cell is full.
+        '''
+        assert (len(features) == len(self.edges))
+        cells, valid = self.learning_cells(np.asarray(features))
+        self.learn_cells(cells, values, weights, keys, valid)
+
+    def learning_cells(self, features):
+        '''
+        Returns the raveled index of the kinematic cell of every calibration
+        event, binned like np.histogramdd, and the mask of valid events.
+        '''
+        return _learning_cells(self.edges, features)
+
+    def learn_cells(self, cells, values, weights, keys=None, valid=None):
+        '''
+        Adds calibration rows in known kinematic cells (see learning_cells)
+        to the reservoirs.
+        '''
+        assert (len(values) == len(self.kinds))
+        if keys is None:
+            keys = np.random.uniform(size=len(cells))
+        values = np.asarray(values, dtype=np.float32)
+        weights = np.asarray(weights, dtype=np.float32)
+        if valid is not None:
+            cells, keys = cells[valid], np.asarray(keys)[valid]
+            values, weights = values[:, valid], weights[valid]
+        if self.stats is not None:
+            self.stats += _weight_stats(
+                cells, weights.astype(np.float64), minlength=len(self.stats))
+        self._keep_rows(cells, values, weights, keys)
+
+    def _keep_rows(self, cells, values, weights, keys):
+        '''
+        Adds rows to the reservoirs and keeps the ones with the smallest keys
+        '''
+        row_cells = np.concatenate([self.row_cells, cells])
+        keys = np.concatenate([self.keys, keys])
+        order = np.lexsort((keys, row_cells))
+        row_cells = row_cells[order]
+        rank = np.arange(len(row_cells)) - np.searchsorted(
+            row_cells, row_cells)
+        keep = order[rank < self.capacity]
+
+        self.row_cells = row_cells[rank < self.capacity]
+        self.keys = keys[keep]
+        self.values = np.concatenate([self.values, values.T])[keep]
+        self.weights = np.concatenate([self.weights, weights])[keep]
+        self._cache.clear()
+        self.redirect = None
+
+    def _add(self, other):
+        '''
+        Merges the reservoirs of a resampler with the same binning
+        '''
+        self._keep_rows(other.row_cells, other.values.T, other.weights,
+                        other.keys)
+        if self.stats is not None and other.stats is not None:
+            self.stats = self.stats + other.stats
+        else:
+            self.stats = None
+
+    def _cell_stats(self, cells):
+        return self.stats[cells]
+
+    def _cell_weights(self):
+        shape = tuple(len(e) - 1 for e in self.edges)
+        # the kept rows are capped, the statistics cover all learned rows
+        if self.stats is not None:
+            return np.clip(self.stats[:, 0], 0, None).reshape(shape)
+        return np.bincount(
+            self.row_cells,
+            np.clip(self.weights, 0, None),
+            minlength=int(np.prod(shape))).reshape(shape)
+
+    def _scale(self, factor):
+        self.weights = self.weights * np.float32(factor)
+        if self.stats is not None:
+            self.stats = self.stats * [factor, factor**2]
+        self._cache.clear()
+        self.redirect = None
+
+    def _check_compatible(self, other):
+        if not isinstance(other, ReservoirResampler):
+            raise TypeError('Cannot combine {} with a {}'.format(
+                type(self).__name__, type(other).__name__))
+        if not _same_edges(self.edges, other.edges):
+            raise ValueError('Resamplers have different bin edges')
+        if self.kinds != other.kinds:
+            raise ValueError('Joint resamplers have different PID kinds')
+
+    def sample_cells(self, cells, kinds, uniforms=None):
+        '''
+        Draws one calibration row per event from the reservoir of its
+        kinematic cell and returns the requested kinds as an array of shape
+        (len(kinds), n_events). All kinds share the random numbers of the
+        first kind, uniforms is of shape (len(kinds), 2, n_events).
+        '''
+        if uniforms is None:
+            uniforms = np.random.uniform(size=(len(kinds), 2, len(cells)))
+        cells = self._redirect_cells(cells)
+        if 'cumulative' not in self._cache:
+            self._cache['cumulative'] = np.cumsum(
+                np.clip(self.weights, 0, None), dtype=np.float64)
+        cumulative = np.append([0], self._cache['cumulative'])
+        start = np.searchsorted(self.row_cells, cells, side='left')
+        end = np.searchsorted(self.row_cells, cells, side='right')
+        total = cumulative[end] - cumulative[start]
+        target = cumulative[start] + uniforms[0, 0] * total
+        rows = np.searchsorted(cumulative, target, side='right') - 1
+        rows = np.clip(rows, start, np.maximum(end - 1, start))
+
+        columns = [self.kinds.index(kind) for kind in kinds]
+        filled = total > 0
+        sampled_val = np.full((len(kinds), len(cells)), -1000.)
+        sampled_val[:, filled] = self.values[rows[filled]][:, columns].T
+        return sampled_val
+
+    def sample_many(self, features, kinds, uniforms=None):
+        '''
+        Samples the given PID kinds jointly for the events described by
+        features. Returns an array of shape (len(kinds), n_events).
+        '''
+        assert (len(features) == len(self.edges))
+        return self.sample_cells(
+            self.cells(np.asarray(features)), kinds, uniforms)
+
+
+class QuantileResampler(_CellFallback, _CalibrationStats, _KinematicTable):
+    '''
+    Compiled form of a Resampler that stores n_quantiles + 1 equidistant
+    quantiles of the target distribution of every filled kinematic cell in
+    single precision. A value is drawn by interpolating linearly between the
+    quantiles around a uniform random number, which gives continuous output
+    and small tables. Created with QuantileResampler.compile.
+    '''
+
+    def __init__(self, n_quantiles=64):
+        self.n_quantiles = n_quantiles
+        self._cache = {}
+        self._source = None
+        self.redirect = None
+        self.stats = None
+
+    @classmethod
+    def compile(cls, resampler, n_quantiles=64):
+        '''
+        Returns the quantile table of a (sparse) Resampler. The target
+        distribution is taken to be uniform within every target bin, like
+        when sampling from the histogram.
+        '''
+        rv = cls(n_quantiles)
+        rv.edges = list(resampler.edges)
+        probs, filled = resampler._probabilities()
+        rv.row_cells = resampler._row_cells()[filled]
+        probs = probs[filled]
+        levels = np.linspace(0, 1, n_quantiles + 1)
+        target_edges = np.asarray(resampler.edges[-1])
+        rv.quantiles = np.empty((len(probs), len(levels)), dtype=np.float32)
+        for start in range(0, len(probs), QUANTILE_BLOCKSIZE):
+            block = probs[start:start + QUANTILE_BLOCKSIZE]
+            cdf = np.zeros((len(block), block.shape[1] + 1))
+            np.cumsum(block, axis=1, out=cdf[:, 1:])
+            # exactly one from the upper edge of the last filled bin on
+            last = block.shape[1] - np.argmax(block[:, ::-1] > 0, axis=1)
+            cdf[np.arange(cdf.shape[1]) >= last[:, np.newaxis]] = 1
+            # offset row i by 2 * i to invert all rows with one searchsorted
+            offset = 2 * np.arange(len(block))[:, np.newaxis]
+            flat = (cdf + offset).ravel()
+            # the lowest quantile is the lower edge of the first filled bin
+            side = np.where(levels > 0, 'left', 'right')
+            pos = np.empty((len(block), len(levels)), dtype=int)
+            for s in ('left', 'right'):
+                pos[:, side == s] = np.searchsorted(
+                    flat, (levels[side == s] + offset).ravel(),
+                    side=s).reshape(len(block), -1)
+            bins = np.clip(pos - 1 - offset // 2 * cdf.shape[1], 0,
+                           block.shape[1] - 1)
+            rows = np.arange(len(block))[:, np.newaxis]
+            frac = _bin_fraction(levels, cdf[rows, bins], cdf[rows, bins + 1])
+            rv.quantiles[start:start + len(block)] = target_edges[bins] + \
+                frac * (target_edges[bins + 1] - target_edges[bins])
+        if resampler.redirect is not None:
+            rv.redirect = np.array(resampler.redirect)
+        if resampler.stats is not None:
+            rv.stats = resampler.stats[filled]
+        return rv
+
+    def _to_arrays(self):
+        arrays = {'edges_{}'.format(i): e for i, e in enumerate(self.edges)}
+        arrays.update(row_cells=self.row_cells, quantiles=self.quantiles)
+        if self.redirect is not None:
+            arrays['redirect'] = self.redirect
+        if self.stats is not None:
+            arrays['stats'] = self.stats
+        return {
+            'n_quantiles': self.n_quantiles,
+            'n_edges': len(self.edges)
+        }, arrays
+
+    @classmethod
+    def _from_arrays(cls, attrs, arrays):
+        rv = cls(attrs['n_quantiles'])
+        rv.edges = [
+            arrays['edges_{}'.format(i)] for i in range(attrs['n_edges'])
+        ]
+        rv.row_cells = arrays['row_cells']
+        rv.quantiles = arrays['quantiles']
+        rv.redirect = arrays.get('redirect')
+        rv.stats = arrays.get('stats')
+        return rv
+
+    def copy(self):
+        '''
+        Creates a copy of the resampler
+        '''
+        rv = QuantileResampler(self.n_quantiles)
+        rv.edges = list(self.edges)
+        rv.row_cells = self.row_cells.copy()
+        rv.quantiles = self.quantiles.copy()
+        if self.redirect is not None:
+            rv.redirect = self.redirect.copy()
+        if self.stats is not None:
+            rv.stats = self.stats.copy()
+        return rv
+
+    def _kinematic_edges(self):
+        return self.edges[:-1]
+
+    def _cell_weights(self):
+        # filled cells of tables without statistics get weight one
+        shape = tuple(len(e) - 1 for e in self._kinematic_edges())
+        weights = np.zeros(int(np.prod(shape)))
+        weights[self.row_cells] = 1 if self.stats is None else \
+            np.clip(self.stats[:, 0], 0, None)
+        return weights.reshape(shape)
+
+    def _row_index(self, cells):
+        rows = np.searchsorted(self.row_cells, cells)
+        found = rows < len(self.row_cells)
+        found[found] = self.row_cells[rows[found]] == cells[found]
+        return np.where(found, rows, -1)
+
+    def sample_cells(self, cells, uniforms=None):
+        '''
+        Samples the target variable for events in the given kinematic cells.
+        uniforms are optional random numbers in [0, 1) of shape (2, n_events),
+        only the first row is used.
+        '''
+        if uniforms is None:
+            uniforms = np.random.uniform(size=(2, len(cells)))
+        rows = self._row_index(self._redirect_cells(cells))
+        filled = rows >= 0
+        rows = rows[filled]
+        position = uniforms[0][filled] * self.n_quantiles
+        lower = np.minimum(position.astype(int), self.n_quantiles - 1)
+        sampled_val = np.full(len(cells), -1000.)
+        quantiles = self.quantiles[rows, lower]
+        sampled_val[filled] = quantiles + (position - lower) * (
+            self.quantiles[rows, lower + 1] - quantiles)
+        return sampled_val
+
+    def sample(self, features, uniforms=None):
+        assert (len(features) == len(self.edges) - 1)
+        return self.sample_cells(self.cells(np.asarray(features)), uniforms)
+
+    def sample_many(self, features, kinds, uniforms=None):
+        '''
+        Samples the events described by features, see
+        ReservoirResampler.sample_many. All kinds are sampled from this
+        resampler with their own random numbers.
+        '''
+        cells = self.cells(np.asarray(features))
+        if uniforms is None:
+            uniforms = np.random.uniform(size=(len(kinds), 2, len(cells)))
+        return np.array([self.sample_cells(cells, u) for u in uniforms])
+
+
+class ResamplerBank:
+    '''
+    Resamplers for several PID variables of one particle that share the
+    kinematic binning. The kinematic cells of the events are looked up once
+    and the target histograms of all resamplers are stacked into one table,
+    so all requested PID variables are sampled with a single searchsorted.
+    '''
+
+    def __init__(self, resamplers):
+        self.resamplers = dict(resamplers)
+        self.edges = next(iter(self.resamplers.values())).edges[:-1]
+        for kind, resampler in self.resamplers.items():
+            if not _same_edges(resampler.edges[:-1], self.edges):
+                raise ValueError(
+                    'Kinematic binning of {} differs from the other '
+                    'resamplers'.format(kind))
+        self._cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = {}
+
+    def cells(self, features):
+        '''
+        Returns the raveled index of the kinematic cell of every event
+        '''
+        return _kinematic_cells(self.edges, features)
+
+    def _cdf_table(self):
+        '''
+        Returns the cumulative target distributions of all resamplers stacked
+        along the first axis, with rows for the union of their stored cells
+        and target bins padded to the widest binning, offset like in
+        Resampler._cdf_table. Also returns the mask of filled rows, the cell
+        index of every row and the position of every kind in the stack.
+        '''
+        if 'cdf' not in self._cache:
+            row_cells = np.unique(
+                np.concatenate(
+                    [r._row_cells() for r in self.resamplers.values()]))
+            n_target = max(
+                len(r.edges[-1]) - 1 for r in self.resamplers.values())
+            # Padded bins keep the cumulative value at one and are never hit
+            cdf = np.ones((len(self.resamplers), len(row_cells), n_target))
+            filled = np.zeros(cdf.shape[:2], dtype=bool)
+            position = {}
+            for k, (kind, resampler) in enumerate(self.resamplers.items()):
+                probs, resampler_filled = resampler._probabilities()
+                rows = resampler._row_index(row_cells)
+                stored = rows >= 0
+                rows = rows[stored]
+                block = np.cumsum(probs[rows], axis=1)
+                block[resampler_filled[rows], -1] = 1
+                cdf[k, stored, :probs.shape[1]] = block
+                filled[k, stored] = resampler_filled[rows]
+                position[kind] = k
+            cdf = cdf.reshape(-1, n_target)
+            cdf += np.arange(len(cdf))[:, np.newaxis]
+            self._cache['cdf'] = cdf, filled, row_cells, position
+        return self._cache['cdf']
+
+    def sample_cells(self, cells, kinds, uniforms=None):
+        '''
+        Samples the given PID kinds for events in the given kinematic cells.
+        Returns an array of shape (len(kinds), n_events).
+        uniforms are optional random numbers in [0, 1) of shape
+        (len(kinds), 2, n_events).
+        '''
+        if uniforms is None:
+            uniforms = np.random.uniform(size=(len(kinds), 2, len(cells)))
+        resamplers = [self.resamplers[kind] for kind in kinds]
+        if any(r.backend != 'cdf' for r in resamplers):
+            return np.array([
+                r.sample_cells(cells, u) for r, u in zip(resamplers, uniforms)
+            ])
+
+        cdf, filled, row_cells, position = self._cdf_table()
+        n_rows = len(row_cells)
+        if n_rows == 0:
+            return np.full((len(kinds), len(cells)), -1000.)
+        n_target = cdf.shape[1]
+        if any(r.redirect is not None for r in resamplers):
+            # every kind follows its own fallback cells
+            cells = np.array([r._redirect_cells(cells) for r in resamplers])
+        rows = np.minimum(np.searchsorted(row_cells, cells), n_rows - 1)
+        stored = row_cells[rows] == cells
+        stack = np.array([position[kind] for kind in kinds])[:, np.newaxis]
+        rows = stack * n_rows + rows
+        offset = rows + uniforms[:, 0]
+        pos = np.searchsorted(cdf.ravel(), offset, side='right')
+        sampled_bin = np.clip(pos - rows * n_target, 0, n_target - 1)
+        pos = rows * n_target + sampled_bin
+        upper = cdf.ravel()[pos]
+        lower = np.where(sampled_bin > 0, cdf.ravel()[pos - 1], rows)
+        frac = _bin_fraction(offset, lower, upper)
+
+        sampled_val = np.empty(offset.shape)
+        for i, resampler in enumerate(resamplers):
+            target_edges = resampler.edges[-1]
+            bins = np.minimum(sampled_bin[i], len(target_edges) - 2)
+            sampled_val[i] = target_edges[bins] + frac[i] * (
+                target_edges[bins + 1] - target_edges[bins])
+        # If the histogram is empty, we can't sample
+        sampled_val[~(filled.ravel()[rows] & stored)] = -1000
+        return sampled_val
+
+    def sample_many(self, features, kinds, uniforms=None):
+        '''
+        Samples the given PID kinds for the events described by features.
+        Returns an array of shape (len(kinds), n_events).
+        '''
+        assert (len(features) == len(self.edges))
+        if any(self.resamplers[kind].backend == 'interp' for kind in kinds):
+            # interpolation needs the positions of the events in their cells
+            if uniforms is None:
+                uniforms = np.random.uniform(
+                    size=(len(kinds), 2, len(features[0])))
+            return np.array([
+                self.resamplers[kind].sample(features, u)
+                for kind, u in zip(kinds, uniforms)
+            ])
+        return self.sample_cells(
+            self.cells(np.asarray(features)), kinds, uniforms)
+
+    def redirected_many(self, features, kinds):
+        '''
+        Returns the mask of events sampled from a fallback cell, of shape
+        (len(kinds), n_events)
+        '''
+        cells = self.cells(np.asarray(features))
+        return np.array(
+            [self.resamplers[kind].redirected_cells(cells) for kind in kinds])
+
+    def calibration_stats_many(self, features, kinds):
+        '''
+        Returns the sum of weights and the effective number of entries of
+        the calibration data used for every event, see
+        Resampler.calibration_stats, both of shape (len(kinds), n_events)
+        '''
+        cells = self.cells(np.asarray(features))
+        sumw, neff = zip(*[
+            self.resamplers[kind].calibration_stats(cells) for kind in kinds
+        ])
+        return np.array(sumw), np.array(neff)
+
+
+class EventRandom:
+    '''
+    Counter based random stream. The random numbers of an event only depend
+    on the seed, the name of the stream and the global entry number of the
+    event, so any chunking or number of processes gives identical results.
+    '''
+
+    def __init__(self, seed, name):
+        from hashlib import sha256
+        digest = sha256('{}:{}'.format(seed, name).encode()).digest()
+        self.key = int.from_bytes(digest[:16], 'little')
+
+    def uniforms(self, first_entry, n_events):
+        '''
+        Returns random numbers in [0, 1) of shape (2, n_events) for the
+        entries first_entry, ..., first_entry + n_events - 1
+        '''
+        # Every entry gets its own Philox block of four 64 bit numbers
+        bitgen = np.random.Philox(key=self.key, counter=first_entry)
+        raw = bitgen.random_raw(4 * n_events).reshape(n_events, 4)[:, :2]
+        return (raw.T >> np.uint64(11)) * 2.0**-53
+
+
+class CoverageReport:
+    '''
+    Number of resampled events in every kinematic cell, per resampled branch
+    and resampler kind, accumulated over all chunks and source files. Cells
+    with a sum of calibration weights below threshold count as low
+    statistics.
+    '''
+
+    def __init__(self, threshold=0):
+        self.threshold = threshold
+        self.hits = {}
+        self.samplers = {}
+
+    def add(self, name, kind, sampler, hits):
+        '''
+        Adds the cell hit counts (as from np.bincount) of branch name
+        resampled from sampler, the resampler of the given kind
+        '''
+        key = (name, kind)
+        self.hits[key] = _add_counts(self.hits.get(key), hits)
+        self.samplers[key] = sampler
+
+    def _cells(self, key):
+        '''
+        Returns the hit counts and the calibration weights of all kinematic
+        cells of key
+        '''
+        weights = self.samplers[key]._cell_weights()
+        hits = np.zeros(weights.size, dtype=np.int64)
+        hits[:len(self.hits[key])] = self.hits[key]
+        return hits, weights
+
+    def summary(self):
+        '''
+        Returns a dictionary with the coverage of every branch and kind:
+        event counts in total, in empty and low statistics cells and in
+        redirected cells, and the bins (under/overflow bin first) of the hit
+        empty and low statistics cells with their event counts
+        '''
+        rv = {}
+        for key in sorted(self.hits):
+            hits, weights = self._cells(key)
+            empty = hits.astype(bool) & (weights.ravel() <= 0)
+            low = hits.astype(bool) & (weights.ravel() > 0) & \
+                (weights.ravel() < self.threshold)
+            redirect = self.samplers[key].redirect
+            redirected = 0
+            if redirect is not None:
+                redirected = hits[redirect != np.arange(len(redirect))].sum()
+            rv.setdefault(key[0], {})[key[1]] = {
+                'n_events': int(hits.sum()),
+                'n_cells': int(hits.size),
+                'cells_hit': int(np.count_nonzero(hits)),
+                'empty_events': int(hits[empty].sum()),
+                'low_statistics_events': int(hits[low].sum()),
+                'redirected_events': int(redirected),
+                'failed_events':
+                int(hits[empty].sum() if redirect is None else 0),
+                'empty_cells': _cell_list(hits, empty, weights.shape),
+                'low_statistics_cells': _cell_list(hits, low, weights.shape),
+            }
+        return rv
+
+    def write(self, path):
+        '''
+        Writes the summary as JSON, or for files ending in .npz the summary
+        and the hit counts and calibration weights of all cells as arrays
+        named hits/<branch>/<kind> and weights/<branch>/<kind>
+        '''
+        summary = {'threshold': self.threshold, 'branches': self.summary()}
+        if not path.endswith('.npz'):
+            with open(path, 'w') as f:
+                json.dump(summary, f)
+            return
+        arrays = {'summary': np.array(json.dumps(summary))}
+        for key in self.hits:
+            hits, weights = self._cells(key)
+            arrays['hits/{}/{}'.format(*key)] = hits.reshape(weights.shape)
+            arrays['weights/{}/{}'.format(*key)] = weights
+        np.savez_compressed(path, **arrays)
+
+
+def _add_counts(total, counts):
+    '''
+    Adds two arrays of counts per cell, padding the shorter one with zeros.
+    total may be None.
+    '''
+    if total is None:
+        return counts
+    size = max(len(total), len(counts))
+    return np.pad(total, (0, size - len(total))) + \
+        np.pad(counts, (0, size - len(counts)))
+
+
+def _cell_list(hits, mask, shape):
+    '''
+    Returns the bin indices and hit counts of the cells in mask, most hit
+    cells first
+    '''
+    cells = np.flatnonzero(mask)
+    cells = cells[np.argsort(-hits[cells], kind='stable')]
+    bins = np.transpose(np.unravel_index(cells, shape))
+    return [{
+        'bins': [int(b) for b in cell_bins],
+        'events': int(hits[cell])
+    } for cell, cell_bins in zip(cells, bins)]
+
+
+class SharedArrays:
+    '''
+    numpy arrays in one block of shared memory. Other processes attach to
+    the block with the small descriptor of the arrays they need instead of
+    receiving pickled copies.
+    '''
+
+    def __init__(self, specs):
+        '''
+        Creates the block for the arrays in specs, a dictionary of their
+        shapes and dtypes
+        '''
+        from multiprocessing import shared_memory
+        self.layout = {}
+        size = 0
+        for key, (shape, dtype) in specs.items():
+            dtype = np.dtype(dtype)
+            self.layout[key] = (size, tuple(shape), dtype.str)
+            size = _align(size + int(np.prod(shape)) * dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.owner = True
+
+    @classmethod
+    def attach(cls, descriptor):
+        '''
+        Attaches to the block of a descriptor from SharedArrays.descriptor
+        '''
+        from multiprocessing import shared_memory
+        rv = cls.__new__(cls)
+        name, rv.layout = descriptor
+        rv.shm = shared_memory.SharedMemory(name=name)
+        rv.owner = False
+        return rv
+
+    def descriptor(self, keys):
+        '''
+        Returns the picklable descriptor of the arrays with the given keys
+        '''
+        return self.shm.name, {key: self.layout[key] for key in keys}
+
+    def arrays(self):
+        '''
+        Returns a dictionary of the arrays as views into the block. They
+        have to be deleted before closing the block.
+        '''
+        return {
+            key: np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset)
+            for key, (offset, shape, dtype) in self.layout.items()
+        }
+
+    def close(self):
+        '''
+        Detaches from the block, which is freed if it was created here
+        '''
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# Binary resampler files start with the magic bytes followed by the format
+# version, the length of the JSON header and the header itself. The arrays
+# follow, each aligned to _ALIGNMENT bytes, so they can be memory mapped.
+RESAMPLER_MAGIC = b'PIDRESMP'
+RESAMPLER_FORMAT_VERSION = 1
+_ALIGNMENT = 64
+# Classes that can be stored in binary resampler files
+_FILE_TYPES = {
+    'Resampler': Resampler,
+    'SparseResampler': SparseResampler,
+    'ReservoirResampler': ReservoirResampler,
+    'QuantileResampler': QuantileResampler,
+}
+
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def save_resamplers(resamplers, path):
+    '''
+    Saves a dictionary of resamplers. Files ending in .pkl are pickled, all
+    others use the memory mappable binary format.
+    '''
+    import struct
+    if path.endswith('.pkl'):
+        import pickle
+        # Mapped resamplers would only pickle a reference to their file
+        copies = {}
+        for r in resamplers.values():
+            if r._source is not None and id(r) not in copies:
+                copies[id(r)] = r.copy()
+        with open(path, 'wb') as f:
+            pickle.dump({
+                kind: copies.get(id(r), r)
+                for kind, r in resamplers.items()
+            }, f)
+        return
+
+    # Resamplers shared between several kinds are stored once
+    entries = []
+    index = {}
+    entry_ids = {}
+    blobs = []
+    offset = 0
+    for kind, resampler in resamplers.items():
+        if id(resampler) not in entry_ids:
+            attrs, arrays = resampler._to_arrays()
+            entry = {
+                'type': type(resampler).__name__,
+                'attrs': attrs,
+                'arrays': {}
+            }
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                offset = _align(offset)
+                entry['arrays'][name] = {
+                    'offset': offset,
+                    'dtype': array.dtype.str,
+                    'shape': list(array.shape)
+                }
+                blobs.append((offset, array))
+                offset += array.nbytes
+            entry_ids[id(resampler)] = len(entries)
+            entries.append(entry)
+        index[kind] = entry_ids[id(resampler)]
+
+    header = json.dumps({'resamplers': index, 'entries': entries}).encode()
+    preamble = RESAMPLER_MAGIC + struct.pack(
+        '<IQ', RESAMPLER_FORMAT_VERSION, len(header))
+    data_start = _align(len(preamble) + len(header))
+    with open(path, 'wb') as f:
+        f.write(preamble)
+        f.write(header)
+        for blob_offset, array in blobs:
+            f.seek(data_start + blob_offset)
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+
+def _load_mapped_resamplers(path, kinds):
+    import os
+    import struct
+    with open(path, 'rb') as f:
+        f.seek(len(RESAMPLER_MAGIC))
+        version, header_length = struct.unpack('<IQ', f.read(12))
+        if version > RESAMPLER_FORMAT_VERSION:
+            raise ValueError(
+                '{} has format version {}, only versions up to {} are '
+                'supported'.format(path, version, RESAMPLER_FORMAT_VERSION))
+        header = json.loads(f.read(header_length).decode())
+    data_start = _align(len(RESAMPLER_MAGIC) + 12 + header_length)
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+
+    resamplers = {}
+    loaded = {}
+    for kind, entry_id in header['resamplers'].items():
+        if kinds is not None and kind not in kinds:
+            continue
+        if entry_id not in loaded:
+            entry = header['entries'][entry_id]
+            arrays = {}
+            for name, spec in entry['arrays'].items():
+                dtype = np.dtype(spec['dtype'])
+                start = data_start + spec['offset']
+                size = dtype.itemsize * int(np.prod(spec['shape']))
+                arrays[name] = buffer[start:start + size].view(dtype).reshape(
+                    spec['shape'])
+            loaded[entry_id] = _FILE_TYPES[entry['type']]._from_arrays(
+                entry['attrs'], arrays)
+            loaded[entry_id]._source = (os.path.abspath(path), kind)
+        resamplers[kind] = loaded[entry_id]
+    return resamplers
+
+
+def load_resamplers(path, kinds=None):
+    '''
+    Loads the dictionary of resamplers stored in a resampler file.
+    Binary resampler files are memory mapped and only the given kinds are
+    loaded.
+    '''
+    import pickle
+    with open(path, 'rb') as f:
+        if f.read(len(RESAMPLER_MAGIC)) == RESAMPLER_MAGIC:
+            return _load_mapped_resamplers(path, kinds)
+        f.seek(0)
+        try:
+            return pickle.load(f)
+        except UnicodeDecodeError:  # pickled with python2
+            f.seek(0)
+            return pickle.load(f, encoding='latin1')
+
+
+def combine_resamplers(resamplers, weights=None):
+    '''
+    Returns the weighted sum of resamplers with compatible binnings, e.g.
+    of both magnet polarities or of several years weighted by luminosity.
+    '''
+    if weights is None:
+        weights = [1.] * len(resamplers)
+    if len(weights) != len(resamplers):
+        raise ValueError('Got {} weights for {} resamplers'.format(
+            len(weights), len(resamplers)))
+    if any(isinstance(r, QuantileResampler) for r in resamplers):
+        raise ValueError(
+            'Compiled quantile tables cannot be combined. Combine the '
+            'resamplers before compiling them.')
+    total = resamplers[0] * weights[0]
+    for resampler, weight in zip(resamplers[1:], weights[1:]):
+        total += resampler if weight == 1 else resampler * weight
+    return total
+
+
+def merge_resamplers(options):
+    inputs = [load_resamplers(path) for path in options.inputs]
+    kinds = sorted(inputs[0])
+    for path, resamplers in zip(options.inputs[1:], inputs[1:]):
+        if sorted(resamplers) != kinds:
+            raise ValueError('{} and {} contain different PID kinds'.format(
+                options.inputs[0], path))
+    for path, resamplers in zip(options.inputs, inputs):
+        for kind, resampler in sorted(resamplers.items()):
+            if isinstance(resampler, QuantileResampler):
+                raise ValueError(
+                    '{} in {} is a compiled quantile table, which cannot be '
+                    'merged. Merge the resamplers before compiling them.'
+                    .format(kind, path))
+    merged = dict()
+    for kind in kinds:
+        if kind in merged:
+            continue
+        logging.info('Merging {}'.format(kind))
+        combined = combine_resamplers(
+            [resamplers[kind] for resamplers in inputs], options.weights)
+        # joint resamplers are shared by several kinds, merge them only once
+        for other in kinds:
+            if inputs[0][other] is inputs[0][kind]:
+                merged[other] = combined
+    if options.fallback_threshold is not None:
+        _build_redirects(merged.values(), options.fallback_threshold)
+    save_resamplers(merged, options.output)
+
+
+def _build_redirects(resamplers, threshold):
+    '''
+    Builds the fallback cells of all (distinct) resamplers
+    '''
+    for resampler in {id(r): r for r in resamplers}.values():
+        resampler.build_redirect(threshold)
+
+
+def coarsen_resamplers(options):
+    resamplers = load_resamplers(options.source)
+    for kind, resampler in sorted(resamplers.items()):
+        if isinstance(resampler, QuantileResampler):
+            raise ValueError(
+                '{} is a compiled quantile table, which cannot be rebinned. '
+                'Coarsen the resamplers before compiling them.'.format(kind))
+    coarse = dict()
+    for kind, resampler in sorted(resamplers.items()):
+        if kind in coarse:
+            continue
+        n_kinematic = len(resampler.edges)
+        if isinstance(resampler, Resampler):
+            n_kinematic -= 1
+        factors = options.kinematic_factors or [1] * n_kinematic
+        if len(factors) != n_kinematic:
+            raise ValueError('{} has {} kinematic axes, got {} factors'.format(
+                kind, n_kinematic, len(factors)))
+        if isinstance(resampler, Resampler):
+            factors = list(factors) + [options.target_factor]
+        rebinned = resampler.rebin(factors)
+        logging.info('Rebinned {} from {} to {}'.format(
+            kind, ' x '.join(str(len(e) - 1) for e in resampler.edges),
+            ' x '.join(str(len(e) - 1) for e in rebinned.edges)))
+        # joint resamplers are shared by several kinds
+        for other in resamplers:
+            if resamplers[other] is resampler:
+                coarse[other] = rebinned
+    if options.fallback_threshold is not None:
+        _build_redirects(coarse.values(), options.fallback_threshold)
+    save_resamplers(coarse, options.target)
+
+
+def compile_resamplers(options):
+    resamplers = load_resamplers(options.source)
+    compiled = dict()
+    for kind, resampler in resamplers.items():
+        if isinstance(resampler, Resampler):
+            logging.info('Compiling {}'.format(kind))
+            compiled[kind] = QuantileResampler.compile(
+                resampler, options.quantiles)
+        else:
+            compiled[kind] = resampler
+    save_resamplers(compiled, options.target)
+
+
+def convert_resamplers(options):
+    logging.info('Converting {} to {}'.format(options.source, options.target))
+    save_resamplers(load_resamplers(options.source), options.target)
+
+
 def rooBinning_to_list(rooBinning):
     return [rooBinning.binLow(i) for i in range(rooBinning.numBins())
             ] + [rooBinning.binHigh(rooBinning.numBins() - 1)]
@@ -123,12 +1938,107 @@ def grab_data(options):
             ws.Delete()
 
 
+# Calibration data is read in chunks of CALIBRATION_CHUNKSIZE entries and
+# create_resamplers distributes work units of _UNIT_CHUNKS chunks
+CALIBRATION_CHUNKSIZE = 100000
+_UNIT_CHUNKS = 10
+# resolution of the quantile sketches used for equal population binning
+SKETCH_BINS = 2**14
+
+
+def _prefetch(iterable, size=1):
+    '''
+    Iterates over iterable in a background thread that keeps up to size
+    items ready, so that e.g. reading the next chunk overlaps with
+    processing the current one
+    '''
+    import threading
+    from queue import Queue
+    queue = Queue(maxsize=size)
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((True, item))
+        except Exception as e:
+            queue.put((False, e))
+        queue.put((False, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        ok, item = queue.get()
+        if not ok:
+            if item is not None:
+                raise item
+            return
+        yield item
+
+
+class QuantileSketch:
+    '''
+    Mergeable summary of a weighted distribution with bounded memory: a fine
+    histogram between lower and upper. Quantiles are resolved to one bin of
+    it, values outside of the range are ignored.
+    '''
+
+    def __init__(self, lower, upper, n_bins=SKETCH_BINS):
+        self.edges = np.linspace(lower, upper, n_bins + 1)
+        self.counts = np.zeros(n_bins)
+
+    def add(self, values, weights=None):
+        idx, valid = _digitize(self.edges, np.asarray(values, dtype=float))
+        if weights is not None:
+            weights = np.asarray(weights)[valid]
+        self.counts += np.bincount(
+            idx[valid], weights=weights, minlength=len(self.counts))
+
+    def _add(self, other):
+        self.counts += other.counts
+
+    def quantiles(self, n):
+        '''
+        Returns up to n + 1 edges from lower to upper that split the
+        distribution into n parts of equal weight. Bins with a negative sum
+        of (s)weights count as empty.
+        '''
+        cumulative = np.cumsum(np.clip(self.counts, 0, None))
+        targets = cumulative[-1] * np.arange(1, n) / n
+        inner = self.edges[1:][np.searchsorted(cumulative, targets)]
+        return np.unique(
+            np.concatenate([self.edges[:1], inner, self.edges[-1:]]))
+
+
+def _equal_population_binning(sketches, binning, n_cells):
+    '''
+    Returns kinematic bin edges with about n_cells cells in total. The
+    number of bins of the default binning is scaled by the same factor along
+    every axis and the edges are placed at quantiles of the calibration data.
+    '''
+    scale = (float(n_cells) / np.prod([len(b) - 1 for b in binning]))**(
+        1. / len(binning))
+    rv = []
+    for sketch, edges in zip(sketches, binning):
+        if np.clip(sketch.counts, 0, None).sum() > 0:
+            n_bins = max(1, int(round(scale * (len(edges) - 1))))
+            edges = sketch.quantiles(n_bins).tolist()
+        rv.append(edges)
+    return rv
+
+
 def create_resamplers(options):
     import os
-    import pickle
-    from root_pandas import read_root
+    import multiprocessing as mp
     from PIDPerfScripts.Binning import GetBinScheme
 
+    # the bin edges depend on all input files, a new file would invalidate
+    # every checkpoint
+    if options.incremental and (options.equal_population
+                                or options.target_bins):
+        logging.error('--incremental cannot be combined with '
+                      '--equal-population or --target-bins, their bin '
+                      'edges depend on all input files.')
+        exit()
+
     # TupleToolANNPID stores all available tunes whereas TupleToolPid stores
     # only the default tune as {}_ProbNNX
     # Information on the default tunes can be found here:
@@ -191,6 +2101,8 @@ def create_resamplers(options):
         locations = [
             sample for sample in locations if sample['magnet'] == 'Up'
         ]
+    specs = []
+    units = []
     for sample in locations:
         # last argument takes name of user-defined binning
         binning_P = rooBinning_to_list(
@@ -216,8 +2128,8 @@ def create_resamplers(options):
                         **sample)
                 ]
                 resampler_location = options.saveto + \
-                    '/{particle}_Stripping{stripping}_MagnetAny.pkl'.format(
-                        **sample
+                    '/{particle}_Stripping{stripping}_MagnetAny.{ext}'.format(
+                        ext=options.format, **sample
                     )
         else:
             data = [
@@ -226,66 +2138,436 @@ def create_resamplers(options):
                     **sample)
             ]
             resampler_location = options.saveto + \
-                '/{particle}_Stripping{stripping}_Magnet{magnet}.pkl'.format(
-                    **sample
+                '/{particle}_Stripping{stripping}_Magnet{magnet}.{ext}'.format(
+                    ext=options.format, **sample
                 )
-        if os.path.exists(resampler_location):
-            os.remove(resampler_location)
-        resamplers = dict()
-        deps = [x.format(sample['branch_particle']) for x in kin_variables]
         pids = [x.format(sample['branch_particle']) for x in pid_variables]
-        for pid in pids:
-            if 'DLL' in pid:
-                # binning for DLL
-                target_binning = np.linspace(-150, 150, 300)
-            elif 'ProbNN' in pid and 'Trafo' in pid:
-                # binning for transformed ProbNN
-                target_binning = np.linspace(-30, 30, 300)
-            elif 'ProbNN' in pid:
-                # binning for (raw) ProbNN
-                target_binning = np.linspace(0, 1, 100)
+        specs.append({
+            'location': resampler_location,
+            'data': data,
+            'deps': [x.format(sample['branch_particle'])
+                     for x in kin_variables],
+            'pids': pids,
+            'binning': [binning_P, binning_ETA, binning_nTracks],
+            'targets': {pid: _target_binning(pid) for pid in pids},
+            'checkpoints': {},
+        })
+
+    if options.jobs > 1:
+        pool = mp.Pool(processes=options.jobs)
+        imap = pool.imap
+    else:
+        pool = None
+        imap = map
+
+    if options.equal_population or options.target_bins:
+        # additional pass over the calibration data to find the bin edges
+        units = [(spec, options, dataSet, start, stop)
+                 for spec in specs for dataSet in spec['data']
+                 for start, stop in _entry_ranges(dataSet, options.tree)]
+        sketches = imap(_sketch_unit, units)
+        for spec in specs:
+            total = None
+            for _ in range(sum(1 for unit in units if unit[0] is spec)):
+                partial = next(sketches)
+                if total is None:
+                    total = partial
+                else:
+                    for name, sketch in partial.items():
+                        total[name]._add(sketch)
+            if total is None:
+                continue
+            if options.equal_population:
+                spec['binning'] = _equal_population_binning(
+                    [total[dep] for dep in spec['deps']], spec['binning'],
+                    options.equal_population)
+                logging.info('Binning of {}: {}'.format(
+                    spec['location'], ' x '.join(
+                        str(len(edges) - 1) for edges in spec['binning'])))
+            if options.target_bins:
+                for pid in spec['pids']:
+                    if np.clip(total[pid].counts, 0, None).sum() > 0:
+                        spec['targets'][pid] = total[pid].quantiles(
+                            options.target_bins)
+
+    units = []
+    for spec in specs:
+        for dataSet in spec['data']:
+            if options.incremental:
+                checkpoint = _checkpoint_path(spec, options, dataSet)
+                spec['checkpoints'][dataSet] = checkpoint
+                if os.path.exists(checkpoint):
+                    logging.info('Using checkpoint {} for {}'.format(
+                        checkpoint, dataSet))
+                    continue
+            for start, stop in _entry_ranges(dataSet, options.tree):
+                units.append((spec, options, dataSet, start, stop))
+
+    # Partial histograms are always summed in the order of the units, so the
+    # result does not depend on the number of jobs
+    partials = imap(_learn_unit, units)
+    for spec in specs:
+        total = None
+        for dataSet in spec['data']:
+            checkpoint = spec['checkpoints'].get(dataSet)
+            if checkpoint is not None and os.path.exists(checkpoint):
+                file_total = _load_partial(checkpoint)
             else:
-                raise Exception
-            resamplers[pid] = Resampler(binning_P, binning_ETA,
-                                        binning_nTracks, target_binning)
-
-        for dataSet in data:
-            # where is None if option is not set
-            for i, chunk in enumerate(
-                    read_root(
-                        dataSet,
-                        options.tree,
-                        columns=deps + pids + ['nsig_sw'],
-                        chunksize=100000,
-                        where=options.cutstring)):
-                for pid in pids:
-                    resamplers[pid].learn(
-                        chunk[deps + [pid]].values.T, weights=chunk['nsig_sw'])
-                logging.info('Finished chunk {}'.format(i))
-        with open(resampler_location, 'wb') as f:
-            pickle.dump(resamplers, f)
+                file_total = None
+                for _ in range(_count_units(units, spec, dataSet)):
+                    file_total = _add_partial(file_total, next(partials))
+                if checkpoint is not None and file_total is not None:
+                    _save_partial(file_total, checkpoint)
+            total = _add_partial(total, file_total)
+        if total is None:
+            total = _empty_resamplers(spec, options)
+        resamplers, joint = total
+        if options.fallback_threshold is not None:
+            redirected = list(resamplers.values())
+            if joint is not None:
+                redirected.append(joint)
+            _build_redirects(redirected, options.fallback_threshold)
+        save_resamplers(resamplers, spec['location'])
+        if joint is not None:
+            root, ext = os.path.splitext(spec['location'])
+            save_resamplers({pid: joint
+                             for pid in spec['pids']}, root + '_Joint' + ext)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def _count_entries(path, tree):
+    '''
+    Returns the number of entries of the tree in the given ROOT file
+    '''
+    if tree is None:
+        from root_numpy import list_trees
+        tree, = list_trees(path)
+    f = R.TFile.Open(path)
+    n_entries = f.Get(tree).GetEntries()
+    f.Close()
+    return n_entries
+
+
+def _entry_ranges(dataSet, tree):
+    '''
+    Splits the entries of an input file into the ranges of the work units
+    '''
+    n_entries = _count_entries(dataSet, tree)
+    step = CALIBRATION_CHUNKSIZE * _UNIT_CHUNKS
+    return [(start, min(start + step, n_entries))
+            for start in range(0, n_entries, step)]
+
+
+def _count_units(units, spec, dataSet):
+    return sum(1 for unit in units if unit[0] is spec and unit[2] == dataSet)
+
+
+def _checkpoint_path(spec, options, dataSet):
+    '''
+    Returns the path of the partial resamplers of one input file. The name
+    contains a hash of everything the partial depends on, so changed input
+    files or settings are not mistaken for accumulated ones.
+    '''
+    import os
+    from hashlib import sha256
+    stat = os.stat(dataSet)
+    key = json.dumps(
+        {
+            'path': os.path.abspath(dataSet),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'tree': options.tree,
+            'cutstring': options.cutstring,
+            'binning': spec['binning'],
+            'targets': [list(spec['targets'][pid]) for pid in spec['pids']],
+            'sparse': options.sparse,
+            'float32': options.float32,
+            'joint': options.joint,
+            'reservoir_size': options.reservoir_size,
+        },
+        sort_keys=True)
+    return os.path.join(
+        os.path.splitext(spec['location'])[0] + '_partials',
+        '{}.{}.pidres'.format(
+            os.path.basename(dataSet),
+            sha256(key.encode()).hexdigest()[:16]))
+
+
+def _save_partial(partial, path):
+    '''
+    Saves the partial resamplers of one input file and removes outdated
+    partials of the same file
+    '''
+    import os
+    from glob import glob
+    directory, name = os.path.split(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for outdated in glob(
+            os.path.join(directory,
+                         name.rsplit('.', 2)[0] + '.*.pidres')):
+        os.remove(outdated)
+    resamplers, joint = partial
+    if joint is not None:
+        resamplers = dict(resamplers, _joint=joint)
+    # write to a temporary file first, so that an interrupted job does not
+    # leave a truncated checkpoint behind
+    save_resamplers(resamplers, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def _load_partial(path):
+    resamplers = {
+        pid: resampler.copy()
+        for pid, resampler in load_resamplers(path).items()
+    }
+    return resamplers, resamplers.pop('_joint', None)
+
+
+def _target_binning(pid):
+    '''
+    Returns the default bin edges of the target axis for a PID variable
+    '''
+    if 'DLL' in pid:
+        # binning for DLL
+        return np.linspace(-150, 150, 300)
+    elif 'ProbNN' in pid and 'Trafo' in pid:
+        # binning for transformed ProbNN
+        return np.linspace(-30, 30, 300)
+    elif 'ProbNN' in pid:
+        # binning for (raw) ProbNN
+        return np.linspace(0, 1, 100)
+    else:
+        raise Exception
+
+
+def _empty_resamplers(spec, options):
+    '''
+    Creates the empty resamplers for one calibration sample, returns the
+    dictionary of histogram resamplers and the joint resampler (or None)
+    '''
+    resamplers = dict()
+    for pid in spec['pids']:
+        resampler_type = SparseResampler if options.sparse else Resampler
+        resamplers[pid] = resampler_type(
+            *spec['binning'] + [spec['targets'][pid]],
+            dtype=np.float32 if options.float32 else np.float64)
+
+    joint = None
+    if options.joint:
+        joint = ReservoirResampler(
+            *spec['binning'],
+            kinds=spec['pids'],
+            capacity=options.reservoir_size)
+    return resamplers, joint
+
+
+def _learn_unit(unit):
+    '''
+    Fills fresh resamplers with the calibration entries [start, stop) of
+    one file
+    '''
+    import os
+    from root_pandas import read_root
+    spec, options, dataSet, start, stop = unit
+    deps, pids = spec['deps'], spec['pids']
+    resamplers, joint = _empty_resamplers(spec, options)
+    # keys deciding which rows stay in the joint reservoirs, unique for
+    # every selected row as at most stop - start rows are read
+    keys = EventRandom(0, os.path.basename(dataSet))
+    key_entry = start
+    # where is None if option is not set
+    chunks = (read_root(
+        dataSet,
+        options.tree,
+        columns=deps + pids + ['nsig_sw'],
+        where=options.cutstring,
+        start=chunk_start,
+        stop=min(chunk_start + CALIBRATION_CHUNKSIZE, stop))
+              for chunk_start in range(start, stop, CALIBRATION_CHUNKSIZE))
+    for chunk in _prefetch(chunks):
+        # all resamplers share the kinematic binning
+        cells, valid = resamplers[pids[0]].learning_cells(
+            chunk[deps].values.T)
+        weights = chunk['nsig_sw'].values
+        for pid in pids:
+            resamplers[pid].learn_cells(cells, chunk[pid].values, weights,
+                                        valid)
+        if joint is not None:
+            joint.learn_cells(
+                cells,
+                chunk[pids].values.T,
+                weights,
+                keys=keys.uniforms(key_entry, len(chunk))[0],
+                valid=valid)
+        key_entry += len(chunk)
+    logging.info('Finished entries {} to {} of {}'.format(
+        start, stop, dataSet))
+    return resamplers, joint
+
+
+def _sketch_unit(unit):
+    '''
+    Returns quantile sketches of the calibration entries [start, stop) of
+    one file: of the kinematic variables for equal population binning and of
+    the PID variables for data driven target binning
+    '''
+    from root_pandas import read_root
+    spec, options, dataSet, start, stop = unit
+    ranges = {}
+    if options.equal_population:
+        ranges.update(zip(spec['deps'], spec['binning']))
+    if options.target_bins:
+        ranges.update(spec['targets'])
+    sketches = {
+        name: QuantileSketch(edges[0], edges[-1])
+        for name, edges in ranges.items()
+    }
+    for chunk_start in range(start, stop, CALIBRATION_CHUNKSIZE):
+        chunk = read_root(
+            dataSet,
+            options.tree,
+            columns=list(sketches) + ['nsig_sw'],
+            where=options.cutstring,
+            start=chunk_start,
+            stop=min(chunk_start + CALIBRATION_CHUNKSIZE, stop))
+        for name, sketch in sketches.items():
+            sketch.add(chunk[name].values, chunk['nsig_sw'].values)
+    return sketches
+
+
+def _add_partial(total, partial):
+    '''
+    Adds partial resamplers, as returned by _learn_unit, to total
+    '''
+    if total is None:
+        return partial
+    if partial is None:
+        return total
+    for pid, resampler in partial[0].items():
+        total[0][pid]._add(resampler)
+    if total[1] is not None:
+        total[1]._add(partial[1])
+    return total
 
 
 def resample_branch(options):
+    import os
     from copy import deepcopy
+    import multiprocessing as mp
+    outputs = {}
+    if options.output:
+        for source_file in options.source_files:
+            name = os.path.splitext(os.path.basename(source_file))[0]
+            outputs[source_file] = options.output.format(name=name)
+        if len(set(outputs.values())) < len(outputs):
+            logging.error('Use {name} in --output to write one file per '
+                          'source file.')
+            exit()
+        for source_file, output in outputs.items():
+            if os.path.abspath(output) == os.path.abspath(source_file):
+                logging.error('--output must not be a source file.')
+                exit()
+    if options.seed is None:
+        options.seed = int(np.random.SeedSequence().entropy % 2**63)
+    logging.info('Using seed {}'.format(options.seed))
+
+    logging.info('Loading config...')
+    with open(options.configfile) as f:
+        config = json.load(f)
+
+    logging.info('Loading resamplers...')
+    resamplers, prefix_dict = _load_task_resamplers(config, options.backend)
+    # forked workers inherit the resamplers, others load them once
+    _RESAMPLE_STATE.update(resamplers=resamplers, prefix_dict=prefix_dict)
+    if options.num_cpu > 1:
+        # workers have to share the tracker of the shared memory blocks
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+        pool = mp.Pool(
+            processes=options.num_cpu,
+            initializer=_init_resample_worker,
+            initargs=(config, options.backend))
+    else:
+        pool = None
+
+    report = None
+    if options.coverage_report:
+        report = CoverageReport(options.coverage_threshold)
     for source_file in options.source_files:
         opt = deepcopy(options)
         opt.source_file = source_file
-        _resample_branch(opt)
+        opt.output = outputs.get(source_file)
+        _resample_branch(opt, config, resamplers, pool, report)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if report is not None:
+        logging.info('Writing coverage report to {}'.format(
+            options.coverage_report))
+        report.write(options.coverage_report)
+
+
+def _load_task_resamplers(config, backend=None):
+    '''
+    Loads the resamplers of all tasks of a resample_branch config. Returns
+    the samplers of every PID kind, indexed by the true id (None without
+    true ids), and the particle prefix of the kinds of every true id.
+    '''
+    prefix_dict = {}
+    resamplers = {}
+
+    use_trueid = 'trueid' in config['tasks'][0]
+    for task in config['tasks'][1:]:
+        if use_trueid and not 'trueid' in task \
+                or not use_trueid and 'trueid' in task:
+            logging.error('Specify true ids on all tasks or on no task.')
+            exit()
 
+    for task in config['tasks'] + config.get('backgrounds', []):
+        resampler = load_resamplers(task['resampler_path'],
+                                    [pid['kind'] for pid in task['pids']])
+        for pid in task['pids']:
+            if not pid['kind'] in resampler:
+                logging.error(
+                    'No resampler found for {kind} in {picklefile}'.format(
+                        kind=pid['kind'], picklefile=task['resampler_path']))
+                exit()
+        # all PIDs of a task are sampled together, joint resamplers sample
+        # their PIDs together by themselves
+        samplers = {}
+        histograms = {}
+        for pid in task['pids']:
+            if isinstance(resampler[pid['kind']], Resampler):
+                if backend:
+                    resampler[pid['kind']].backend = backend
+                histograms[pid['kind']] = resampler[pid['kind']]
+            else:
+                samplers[pid['kind']] = resampler[pid['kind']]
+        if histograms:
+            bank = ResamplerBank(histograms)
+            samplers.update((kind, bank) for kind in histograms)
+
+        for trueid in task.get('trueid', [None]):
+            resamplers[trueid] = resamplers.get(trueid, {})
+            if trueid is None:
+                prefix_dict[trueid] = None
+            else:
+                prefix_dict[trueid] = task['pids'][0]['kind'].split('_')[0]
 
-def _resample_branch(options):
-    import pickle
-    from root_numpy import tree2array, array2tree, list_branches
+            resamplers[trueid].update(samplers)
+    return resamplers, prefix_dict
+
+
+def _resample_branch(options, config, resamplers, pool=None, report=None):
+    import os
+    from root_numpy import tree2array, array2tree, list_branches, list_trees
     from root_pandas import read_root
-    from pandas import DataFrame
-    import multiprocessing as mp
+    from collections import deque
     logging.info('Starting resampling for {}'.format(options.source_file))
 
-    logging.info('Loading config...')
-    with open(options.configfile) as f:
-        config = json.load(f)
-
     branches_in_file = list_branches(
         options.source_file, treename=options.tree)
 
@@ -301,46 +2583,11 @@ def _resample_branch(options):
         raise Exception(
             'Branches exist - resampling seems to be done already.')
 
-    logging.info('Loading resamplers...')
-
-    trueid_branches = []
-    prefix_dict = {}
-    # load resamplers into config dictionary
-    resamplers = {}
-
-    use_trueid = 'trueid' in config['tasks'][0]
-    for task in config['tasks'][1:]:
-        if use_trueid and not 'trueid' in task \
-                or not use_trueid and 'trueid' in task:
-            logging.error('Specify true ids on all tasks or on no task.')
-            exit()
-
-    for task in config['tasks'] + config.get('backgrounds', []):
-        if 'trueid_branch' in task:
-            trueid_branches.append(task['trueid_branch'])
-        with open(task['resampler_path'], 'rb') as f:
-            try:
-                resampler = pickle.load(f)
-            except UnicodeDecodeError:  # pickled with python2
-                resampler = pickle.load(f, encoding='latin1')
-
-            for trueid in task.get('trueid', [None]):
-                resamplers[trueid] = resamplers.get(trueid, {})
-                if trueid is None:
-                    prefix_dict[trueid] = None
-                else:
-                    prefix_dict[trueid] = task['pids'][0]['kind'].split('_')[0]
-
-                for pid in task['pids']:
-                    if not pid['kind'] in resampler:
-                        logging.error(
-                            'No resampler found for {kind} in {picklefile}'.
-                            format(
-                                kind=pid['kind'],
-                                picklefile=task['resampler_path']))
-                        exit()
-
-                    resamplers[trueid][pid['kind']] = resampler[pid['kind']]
+    trueid_branches = [
+        task['trueid_branch']
+        for task in config['tasks'] + config.get('backgrounds', [])
+        if 'trueid_branch' in task
+    ]
 
     needed_branches = [f for task in config['tasks'] for f in task['features']]
 
@@ -361,17 +2608,55 @@ def _resample_branch(options):
                 exit()
     needed_branches = list(set(needed_branches))
 
-    logging.info('Starting resampling...')
+    outputs = []
+    if options.flag_redirected:
+        outputs.append('_redirected')
+    if options.calibration_stats:
+        outputs.extend(['_calibstat', '_neff'])
 
-    resampled_data = DataFrame()
+    logging.info('Starting resampling...')
 
+    # the resampled branches are written chunk by chunk
+    spool = None
+    if options.output:
+        # a new file with only the resampled branches, entry by entry
+        # aligned with the source tree so that it can be used as friend
+        tree_name = options.outputtree or options.tree
+        if tree_name is None:
+            # read_root uses the only tree of the file
+            tree_name, = list_trees(options.source_file)
+        f = R.TFile(options.output + '.tmp', 'RECREATE')
+        if '/' in tree_name:
+            t_path = '/'.join(tree_name.split('/')[:-1])
+            f.mkdir(t_path)
+            f.cd(t_path)
+        t = R.TTree(tree_name.split('/')[-1], 'Resampled PID branches')
+    else:
+        # to a temporary file first, the source file is only changed once
+        # all chunks are resampled, so a failed job leaves it as it was
+        t = None
+        spool = _RecordSpool(
+            os.path.dirname(os.path.abspath(options.source_file)))
+
+    # every source file gets its own random streams, files of the same
+    # production would otherwise get the same random numbers. The file name
+    # is used like in _learn_unit, so that moving the file keeps the output
+    stream = '{}:{}:'.format(
+        os.path.basename(options.source_file), options.tree)
+
+    # chunks are read ahead while up to num_cpu chunks are resampled, the
+    # results are written in order
+    pending = deque()
+    n_written = 0
     chunksize = options.chunksize
+    first_entry = 0
     for i, chunk in enumerate(
-            read_root(
-                options.source_file,
-                options.tree,
-                columns=needed_branches + trueid_branches,
-                chunksize=chunksize)):
+            _prefetch(
+                read_root(
+                    options.source_file,
+                    options.tree,
+                    columns=needed_branches + trueid_branches,
+                    chunksize=chunksize))):
 
         for ps in pseudorapidities_to_calculate:
             logging.info('Calculating pseudorapidity for {}'.format(ps))
@@ -379,8 +2664,9 @@ def _resample_branch(options):
             pz = chunk[ps + '_PZ']
             chunk[ps + '_eta'] = 0.5 * np.log((p + pz) / (p - pz))
 
-        resampled_data_chunk = DataFrame()
         var_name = []
+        task_names = []
+        inputs = []
         args = []
 
         for task in config['tasks']:
@@ -391,68 +2677,349 @@ def _resample_branch(options):
             else:
                 trueid = None
 
+            pids = []
             for pid in task['pids']:
                 if pid['name'] in branches_in_file:
                     logging.info('Skipping {}, branch already exists'.format(
                         pid['name']))
                     continue
-
-                var_name.append(pid['name'])
-                args.append((resamplers, deps.values.T, trueid, pid['kind'],
-                             prefix_dict))
-
-        p = mp.Pool(processes=options.num_cpu)
-        resampled = p.map(resample_process, args)
-        p.terminate()
-
-        # transform branches back
-        for idx, var in enumerate(var_name):
-            resampled_data_chunk[var] = resampled[idx]
-            if 'Trafo' in var and options.transform:
-                logging.info('Back trafo for {}'.format(var))
-                resampled_data_chunk[var.replace('Trafo', 'Untrafo')] = \
-                    back_transform(resampled[idx])
-
-        logging.info('Processed {} entries'.format((i + 1) * chunksize))
-        resampled_data = resampled_data.append(
-            resampled_data_chunk, ignore_index=True)
+                pids.append(pid)
+            if not pids:
+                continue
+
+            var_name.extend(pid['name'] for pid in pids)
+            task_names.append([pid['name'] for pid in pids])
+            inputs.append({'deps': deps.values.T})
+            if trueid is not None:
+                inputs[-1]['trueid'] = trueid.values
+            args.append([
+                inputs[-1], [pid['kind'] for pid in pids],
+                [EventRandom(options.seed, stream + pid['name'])
+                 for pid in pids],
+                first_entry, outputs, report is not None
+            ])
+
+        pending.append(
+            _submit_chunk(pool, inputs, args, len(chunk), outputs))
+        pending[-1].update(var_name=var_name, task_names=task_names)
+        first_entry += len(chunk)
+        while len(pending) > (0 if pool is None else options.num_cpu - 1):
+            n_written += _write_chunk(pending.popleft(), t, spool, options,
+                                      resamplers, report)
+            logging.info('Processed {} entries'.format(n_written))
+
+    while pending:
+        n_written += _write_chunk(pending.popleft(), t, spool, options,
+                                  resamplers, report)
+        logging.info('Processed {} entries'.format(n_written))
 
     logging.info('Writing output...')
-    f = R.TFile(options.source_file, 'UPDATE')
-    t = f.Get(options.tree)
-    if '/' in options.tree:
-        t_path = options.tree.split('/')[:-1]
-        t_dir = f.Get('/'.join(t_path))
-        t_dir.cd()
-    print(resampled_data.tail())
-    array2tree(
-        resampled_data.to_records(index=False), tree=t, name=options.tree)
+    if spool is not None:
+        f = R.TFile(options.source_file, 'UPDATE')
+        t = f.Get(options.tree)
+        if '/' in options.tree:
+            t_path = options.tree.split('/')[:-1]
+            t_dir = f.Get('/'.join(t_path))
+            t_dir.cd()
+        for records in spool:
+            array2tree(records, tree=t, name=options.tree)
+        spool.close()
     t.Write()
     f.Close()
+    if options.output:
+        os.replace(options.output + '.tmp', options.output)
+        logging.info('Resampled branches written to {}'.format(
+            options.output))
+
+
+def _submit_chunk(pool, inputs, args, n_events, outputs):
+    '''
+    Starts resampling the tasks of a chunk, see _resample_task, in the pool
+    or, without a pool, right away. In the pool the inputs and results are
+    exchanged through a SharedArrays block. Returns the state of the chunk
+    for _collect_chunk.
+    '''
+    if pool is None:
+        return {
+            'block': None,
+            'outputs': outputs,
+            'results': [_Finished(_resample_task(task)) for task in args]
+        }
+    # workers read the features from and write the resampled values to
+    # shared memory, only the block layout is pickled
+    specs = {}
+    for t, (task_inputs, task_args) in enumerate(zip(inputs, args)):
+        shape = (len(task_args[1]), n_events)
+        specs.update(((t, key), (value.shape, value.dtype))
+                     for key, value in task_inputs.items())
+        specs[t, 'res'] = (shape, float)
+        specs.update(((t, suffix), (shape, EXTRA_BRANCHES[suffix]))
+                     for suffix in outputs)
+    block = SharedArrays(specs)
+    arrays = block.arrays()
+    for t, task_inputs in enumerate(inputs):
+        for key, value in task_inputs.items():
+            arrays[t, key][...] = value
+        args[t][0] = block.descriptor([key for key in specs if key[0] == t])
+    del arrays
+    return {
+        'block': block,
+        'outputs': outputs,
+        'results':
+        [pool.apply_async(_resample_task, (task, )) for task in args]
+    }
+
+
+def _collect_chunk(job, options, resamplers, report=None):
+    '''
+    Waits for the tasks of a chunk started by _submit_chunk and returns the
+    resampled branches as a DataFrame
+    '''
+    from pandas import DataFrame
+    results = [result.get() for result in job['results']]
+    if job['block'] is not None:
+        arrays = job['block'].arrays()
+        results = [(arrays[t, 'res'].copy(), {
+            suffix: arrays[t, suffix].copy()
+            for suffix in job['outputs']
+        }, hits) for t, (_, _, hits) in enumerate(results)]
+        del arrays
+        job['block'].close()
+
+    resampled = [res for task_res, _, _ in results for res in task_res]
+    extra = [{suffix: values[i]
+              for suffix, values in task_extra.items()}
+             for task_res, task_extra, _ in results
+             for i in range(len(task_res))]
+    if report is not None:
+        for (_, _, task_hits), names in zip(results, job['task_names']):
+            for (i, kind), hits in task_hits.items():
+                report.add(names[i], kind, _kind_resampler(resamplers, kind),
+                           hits)
+
+    resampled_data_chunk = DataFrame()
+    # transform branches back
+    for idx, var in enumerate(job['var_name']):
+        resampled_data_chunk[var] = resampled[idx]
+        for suffix, values in extra[idx].items():
+            resampled_data_chunk[var + suffix] = values
+        if 'Trafo' in var and options.transform:
+            logging.info('Back trafo for {}'.format(var))
+            resampled_data_chunk[var.replace('Trafo', 'Untrafo')] = \
+                back_transform(resampled[idx])
+    return resampled_data_chunk
+
+
+def _write_chunk(job, tree, spool, options, resamplers, report=None):
+    '''
+    Appends the resampled branches of a chunk, see _collect_chunk, to tree
+    or, if given, to spool. Returns the number of entries written.
+    '''
+    from root_numpy import array2tree
+    records = _collect_chunk(job, options, resamplers,
+                             report).to_records(index=False)
+    if spool is not None:
+        spool.append(records)
+    else:
+        array2tree(records, tree=tree, name=options.tree)
+    return len(records)
+
+
+class _RecordSpool:
+    '''
+    Record arrays kept in an anonymous temporary file, which is removed
+    when closed or when the process ends, and read back in the same chunks
+    '''
+
+    def __init__(self, directory=None):
+        import tempfile
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.chunks = []
+
+    def append(self, records):
+        records.tofile(self.file)
+        self.chunks.append((records.dtype, len(records)))
+
+    def __iter__(self):
+        self.file.seek(0)
+        for dtype, n in self.chunks:
+            yield np.fromfile(self.file, dtype=dtype, count=n)
+
+    def close(self):
+        self.file.close()
+
+
+class _Finished:
+    '''
+    Result of a task that was run right away, used like an AsyncResult
+    '''
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def _kind_resampler(resamplers, kind):
+    '''
+    Returns the resampler of the given kind from the resamplers of
+    _resample_branch, looking into banks
+    '''
+    for samplers in resamplers.values():
+        if kind in samplers:
+            sampler = samplers[kind]
+            if isinstance(sampler, ResamplerBank):
+                return sampler.resamplers[kind]
+            return sampler
+    raise KeyError(kind)
+
+
+# Additional per-event branches of resample_branch with their types, named
+# by the suffix appended to the name of the resampled branch
+EXTRA_BRANCHES = {'_redirected': bool, '_calibstat': float, '_neff': float}
+# Resamplers of the processes of resample_branch, see _init_resample_worker
+_RESAMPLE_STATE = {}
+
+
+def _init_resample_worker(config, backend):
+    '''
+    Pool initializer of resample_branch: loads the resamplers of all tasks
+    once per worker process, unless they were inherited from the parent
+    '''
+    if not _RESAMPLE_STATE:
+        resamplers, prefix_dict = _load_task_resamplers(config, backend)
+        _RESAMPLE_STATE.update(
+            resamplers=resamplers, prefix_dict=prefix_dict)
+
+
+def _resample_task(task):
+    '''
+    Resamples one task of a chunk with the resamplers of the process, see
+    resample_process. The inputs are either a dictionary with the features
+    (deps) and the true ids (trueid, optional) or the descriptor of a
+    SharedArrays block, which also receives the results (res and the
+    additional branches) instead of returning them.
+    '''
+    inputs, kinds, streams, first_entry, outputs, coverage = task
+    block = None
+    if not isinstance(inputs, dict):
+        block = SharedArrays.attach(inputs)
+        inputs = {key[-1]: value for key, value in block.arrays().items()}
+    res, extra, hits = resample_process(
+        (_RESAMPLE_STATE['resamplers'], inputs['deps'], inputs.get('trueid'),
+         kinds, _RESAMPLE_STATE['prefix_dict'], streams, first_entry,
+         outputs, coverage))
+    if block is None:
+        return res, extra, hits
+    inputs['res'][...] = res
+    for suffix, values in extra.items():
+        inputs[suffix][...] = values
+    del inputs
+    block.close()
+    return None, None, hits
 
 
 def resample_process(res_deps):
-    resamplers, deps, trueid, pid, prefix_dict = res_deps
-    res = np.zeros(deps.shape[1])
-    mask = np.ones(deps.shape[1], dtype=bool)
+    '''
+    Resamples the PID kinds of one task. Returns the resampled values, a
+    dictionary of the requested additional branches, indexed by the suffix
+    of their name: _redirected, _calibstat and _neff, and if coverage is set
+    the number of events per kinematic cell, indexed by the position of the
+    kind and the name of the resampler used.
+    '''
+    resamplers, deps, trueid, kinds, prefix_dict, streams, first_entry, \
+        outputs, coverage = res_deps
+    n_events = deps.shape[1]
+    res = np.full((len(kinds), n_events), -9999.)
+    extra = {
+        suffix: np.zeros((len(kinds), n_events), dtype=EXTRA_BRANCHES[suffix])
+        for suffix in outputs
+    }
+    hits = {}
+    uniforms = np.array(
+        [stream.uniforms(first_entry, n_events) for stream in streams])
 
     for t in prefix_dict:
         if t is None:
-            res = resamplers[t][pid].sample(deps)
-            mask[:] = False
-            continue
-
-        idx = np.array(trueid == t, dtype=bool)
-        if (idx == False).all(): continue
-
-        mask[idx] = False
-        pid_tail = '_'.join(pid.split('_')[1:])
-        pid_name = '_'.join([prefix_dict[t], pid_tail])
-        res[idx] = resamplers[t][pid_name].sample(deps[:, idx])
-
-    res[mask] = -9999
+            idx = np.ones(n_events, dtype=bool)
+            names = kinds
+        else:
+            idx = np.array(trueid == t, dtype=bool)
+            if not idx.any():
+                continue
+            names = [
+                '_'.join([prefix_dict[t]] + kind.split('_')[1:])
+                for kind in kinds
+            ]
 
-    return res
+        # PIDs sharing a bank are sampled in one go
+        groups = {}
+        for i, name in enumerate(names):
+            groups.setdefault(id(resamplers[t][name]), []).append(i)
+        for group in groups.values():
+            bank = resamplers[t][names[group[0]]]
+            res[np.ix_(group, idx)] = bank.sample_many(
+                deps[:, idx], [names[i] for i in group],
+                uniforms[group][:, :, idx])
+            if '_redirected' in extra:
+                extra['_redirected'][np.ix_(group, idx)] = \
+                    bank.redirected_many(deps[:, idx],
+                                         [names[i] for i in group])
+            if '_calibstat' in extra:
+                sumw, neff = bank.calibration_stats_many(
+                    deps[:, idx], [names[i] for i in group])
+                extra['_calibstat'][np.ix_(group, idx)] = sumw
+                extra['_neff'][np.ix_(group, idx)] = neff
+            if coverage:
+                # several true ids can use the same resampler
+                group_hits = np.bincount(bank.cells(deps[:, idx]))
+                for i in group:
+                    hits[i, names[i]] = _add_counts(
+                        hits.get((i, names[i])), group_hits)
+
+    return res, extra, hits
+
+
+def benchmark_sampling(options):
+    from time import time
+
+    resamplers = load_resamplers(options.resampler_path)
+    kinds = options.kinds or sorted(resamplers)
+    print('{:<30} {:>8} {:>10} {:>10} {:>12}'.format(
+        'kind', 'backend', 'events', 'time [s]', 'ns / event'))
+    for kind in kinds:
+        resampler = resamplers[kind]
+        # the backends only exist for the target histograms of Resampler
+        if not isinstance(resampler, Resampler):
+            logging.warning('Skipping {}: the backends do not apply to {}'
+                            .format(kind, type(resampler).__name__))
+            continue
+        # Draw the cells according to the calibration occupancy to get
+        # realistic memory access patterns
+        occupancy = np.clip(resampler._rows(), 0, None).sum(axis=1)
+        if not occupancy.sum() > 0:
+            logging.warning('Skipping {}: all cells are empty'.format(kind))
+            continue
+        for backend in CELL_BACKENDS:
+            resampler._cache.clear()
+            start = time()
+            resampler.sample_cells(resampler._row_cells()[:1], backend=backend)
+            print('{:<30} {:>8} {:>10} {:>10.4f} {:>12}'.format(
+                kind, backend, 'tables', time() - start, ''))
+            for batch_size in options.batch_sizes:
+                cells = np.random.choice(
+                    resampler._row_cells(),
+                    size=batch_size,
+                    p=occupancy / occupancy.sum())
+                timings = []
+                for _ in range(options.repeat):
+                    start = time()
+                    resampler.sample_cells(cells, backend=backend)
+                    timings.append(time() - start)
+                print('{:<30} {:>8} {:>10} {:>10.4f} {:>12.1f}'.format(
+                    kind, backend, batch_size, min(timings),
+                    min(timings) / batch_size * 1e9))
 
 
 parser = argparse.ArgumentParser()
@@ -481,7 +3048,7 @@ create = subparsers.add_parser(
 create.set_defaults(func=create_resamplers)
 create.add_argument('location', help='Directory where input files are stored.')
 create.add_argument(
-    'saveto', help='Directory where to save the resamplers as .pkl - files.')
+    'saveto', help='Directory where to save the resamplers.')
 create.add_argument(
     '--particles',
     nargs='*',
@@ -505,6 +3072,73 @@ create.add_argument(
     '--tree',
     help='Optional tree name to use. Has to be used if you have multiple trees'
     ' in file or have several subsets of the same tree.')
+create.add_argument(
+    '--jobs',
+    '-j',
+    type=int,
+    default=1,
+    help='Number of processes filling the histograms. The result does not '
+    'depend on it. Default: 1')
+create.add_argument(
+    '--equal-population',
+    dest='equal_population',
+    type=int,
+    metavar='CELLS',
+    help='Place the kinematic bin edges such that the bins contain equal '
+    'amounts of (sWeighted) calibration data, using an additional pass over '
+    'the kinematic variables. The ranges of the default binning schemes are '
+    'kept and about CELLS kinematic cells are used. Default: use the default '
+    'binning schemes')
+create.add_argument(
+    '--target-bins',
+    dest='target_bins',
+    type=int,
+    metavar='BINS',
+    help='Derive the bin edges of every PID variable from quantiles of its '
+    'calibration distribution, with at most BINS bins of variable width in '
+    'the range of the default binning. Uses an additional pass over the '
+    'data. Default: equidistant bins (300 for DLL and transformed ProbNN, '
+    '100 for ProbNN)')
+create.add_argument(
+    '--fallback-threshold',
+    dest='fallback_threshold',
+    type=float,
+    help='Redirect kinematic cells with a sum of sWeights below this '
+    'threshold, or without calibration data, to the nearest cell with enough '
+    'data, so that no event gets -1000. Default: no redirection')
+create.add_argument(
+    '--incremental',
+    action='store_true',
+    help='Keep the histograms of every input file next to the resamplers and '
+    'only process input files that are new or have changed since the last '
+    'run. Not available with --equal-population and --target-bins.')
+create.add_argument(
+    '--sparse',
+    action='store_true',
+    help='Only store occupied kinematic cells. Allows for fine binnings.')
+create.add_argument(
+    '--float32',
+    action='store_true',
+    help='Store the histograms in single precision.')
+create.add_argument(
+    '--joint',
+    action='store_true',
+    help='Additionally create a joint resampler (saved with the suffix _Joint)'
+    ' that draws all PID variables together from a reservoir of calibration '
+    'candidates per kinematic cell, preserving their correlations.')
+create.add_argument(
+    '--reservoir-size',
+    dest='reservoir_size',
+    type=int,
+    default=1000,
+    help='Maximum number of calibration candidates kept per kinematic cell '
+    'for joint resamplers. Default: 1000')
+create.add_argument(
+    '--format',
+    choices=('pkl', 'pidres'),
+    default='pkl',
+    help='File format of the resamplers: pickle (pkl) or the memory mappable '
+    'binary format (pidres). Default: pkl')
 
 resample = subparsers.add_parser(
     'resample_branch',
@@ -532,10 +3166,165 @@ resample.add_argument(
     '--outputtree',
     help='Optional tree name to use. Should be used if you have multiple trees'
     ' in file or if you have a slash in your tree name.')
+resample.add_argument(
+    '--output',
+    '-o',
+    help='Write only the resampled branches to this file instead of adding '
+    'them to the source files, as a tree (named like --outputtree or --tree) '
+    'with the same entries that can be added as friend. Use {name} for the '
+    'name of the source file without extension when resampling several '
+    'files. The source files are only read.')
 resample.add_argument(
     '--transform',
     action='store_true',
     help='Perform in place back transformation for ProbNN variables')
+resample.add_argument(
+    '--seed',
+    type=int,
+    help='Seed of the random numbers. The output only depends on the seed '
+    'and the entry number, not on --num_cpu or --chunksize. Default: random, '
+    'the seed is logged')
+resample.add_argument(
+    '--flag-redirected',
+    dest='flag_redirected',
+    action='store_true',
+    help='Add a branch <name>_redirected for every resampled branch that '
+    'flags events sampled from a fallback cell (see --fallback-threshold '
+    'of create_resamplers)')
+resample.add_argument(
+    '--calibration-stats',
+    dest='calibration_stats',
+    action='store_true',
+    help='Add branches <name>_calibstat (sum of sWeights) and <name>_neff '
+    '(effective number of entries) of the calibration data in the kinematic '
+    'cell every event is sampled from')
+resample.add_argument(
+    '--backend',
+    choices=BACKENDS,
+    help='Sampling backend used for all resamplers. Default: the backend '
+    'stored with each resampler (cdf)')
+resample.add_argument(
+    '--coverage-report',
+    dest='coverage_report',
+    metavar='FILE',
+    help='Write the number of events per kinematic cell and the events in '
+    'cells without or with little calibration data, per branch and '
+    'resampler, to FILE: JSON, or npz with the full per-cell counts if FILE '
+    'ends in .npz')
+resample.add_argument(
+    '--coverage-threshold',
+    dest='coverage_threshold',
+    type=float,
+    default=0,
+    metavar='W',
+    help='Cells with a sum of sWeights below W count as low statistics in '
+    'the coverage report. Default: 0')
+
+convert = subparsers.add_parser(
+    'convert_resamplers',
+    help='Converts a resampler file between the pickle (.pkl) and the binary '
+    'format (any other extension, e.g. .pidres)')
+convert.set_defaults(func=convert_resamplers)
+convert.add_argument('source', help='Resampler file to convert.')
+convert.add_argument(
+    'target',
+    help='Output file. Files ending in .pkl are pickled, all others are '
+    'written in the binary format.')
+
+merge = subparsers.add_parser(
+    'merge_resamplers',
+    help='Combines resampler files with the same binning, e.g. of both magnet'
+    ' polarities or several years, without reading the calibration data')
+merge.set_defaults(func=merge_resamplers)
+merge.add_argument(
+    'output',
+    help='Output file. Files ending in .pkl are pickled, all others are '
+    'written in the binary format.')
+merge.add_argument('inputs', nargs='+', help='Resampler files to combine.')
+merge.add_argument(
+    '--weights',
+    nargs='+',
+    type=float,
+    help='Optional weight of every input file, e.g. its luminosity. '
+    'Default: 1 for all files')
+merge.add_argument(
+    '--fallback-threshold',
+    dest='fallback_threshold',
+    type=float,
+    help='Redirect kinematic cells with a sum of sWeights below this '
+    'threshold, or without calibration data, to the nearest cell with enough '
+    'data, so that no event gets -1000. Default: no redirection')
+
+coarsen = subparsers.add_parser(
+    'coarsen',
+    help='Creates smaller resamplers by merging adjacent bins of existing '
+    'ones, e.g. for fast previews')
+coarsen.set_defaults(func=coarsen_resamplers)
+coarsen.add_argument('source', help='Resampler file to coarsen.')
+coarsen.add_argument(
+    'target',
+    help='Output file. Files ending in .pkl are pickled, all others are '
+    'written in the binary format.')
+coarsen.add_argument(
+    '--kinematic-factors',
+    dest='kinematic_factors',
+    nargs='+',
+    type=int,
+    help='Number of adjacent bins merged along every kinematic axis (P, ETA, '
+    'nTracks). Under/overflow bins are kept. Default: 1 for all axes')
+coarsen.add_argument(
+    '--target-factor',
+    dest='target_factor',
+    type=int,
+    default=1,
+    help='Number of adjacent bins merged along the target axis. '
+    'Default: 1')
+coarsen.add_argument(
+    '--fallback-threshold',
+    dest='fallback_threshold',
+    type=float,
+    help='Rebuild the fallback cells with this threshold, see '
+    'create_resamplers. Default: no redirection')
+
+compile_ = subparsers.add_parser(
+    'compile_resamplers',
+    help='Compiles the histograms of a resampler file into compact tables '
+    'of quantiles per kinematic cell, which resample_branch uses like any '
+    'other resampler')
+compile_.set_defaults(func=compile_resamplers)
+compile_.add_argument('source', help='Resampler file to compile.')
+compile_.add_argument(
+    'target',
+    help='Output file. Files ending in .pkl are pickled, all others are '
+    'written in the binary format.')
+compile_.add_argument(
+    '--quantiles',
+    type=int,
+    default=64,
+    help='Number of quantile intervals stored per kinematic cell. '
+    'Default: 64')
+
+benchmark = subparsers.add_parser(
+    'benchmark_sampling',
+    help='Compares the speed of the sampling backends of a resampler file')
+benchmark.set_defaults(func=benchmark_sampling)
+benchmark.add_argument('resampler_path')
+benchmark.add_argument(
+    '--kinds',
+    nargs='*',
+    help='Optional subset of PID kinds to benchmark. Default: all')
+benchmark.add_argument(
+    '--batch-sizes',
+    dest='batch_sizes',
+    nargs='+',
+    type=int,
+    default=[1000, 10000, 100000, 1000000],
+    help='Numbers of events sampled per call')
+benchmark.add_argument(
+    '--repeat',
+    type=int,
+    default=3,
+    help='Number of repetitions per batch size, the fastest one is reported')
 
 if __name__ == '__main__':
     options = parser.parse_args()